@@ -7,16 +7,24 @@ Content : messaging utility module
 """
 # -*- coding: utf-8 -*-
 import os.path
+import time
+import hmac
 import string
+import hashlib
+import binascii
 import configparser
 from collections import namedtuple
+from functools import lru_cache
 from random import choice
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 
 DEFAULT_KEY_FILENAME = "{}/.pyaiot/keys".format(os.path.expanduser("~"))
 
 Keys = namedtuple('Keys', ['private', 'secret'])
 
+SESSION_PREFIX = 's1'
+SESSION_TOKEN_TTL = 3600  # seconds
+
 def generate_secret_key():
     """
     用字母和数字生成长度为32的随机密钥.
@@ -65,17 +73,102 @@ def check_key_file(filename=DEFAULT_KEY_FILENAME):
     )
 
 
-def verify_auth_token(token, keys):
+@lru_cache(maxsize=16)
+def _fernet(private):
     """
-    校验授权令牌是否有效.
+    Return the Fernet cipher of the given private key, built once.
+    """
+    return Fernet(private.encode())
+
+
+@lru_cache(maxsize=16)
+def _session_key(private, secret):
+    """
+    Return the HMAC key used to sign session tokens.
+    """
+    return hashlib.sha256(
+        'pycots-session:{}:{}'.format(private, secret).encode()
+    ).digest()
+
+
+def _session_signature(keys, payload):
+    return hmac.new(
+        _session_key(keys.private, keys.secret), payload.encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def session_token(keys, ttl=SESSION_TOKEN_TTL):
+    """
+    生成会话令牌.
+    Generate a session token, valid for `ttl` seconds, that is verified
+    with a single HMAC instead of a Fernet decryption.
+    """
+    payload = '{}:{}:{}'.format(
+        SESSION_PREFIX, int(time.time()) + ttl,
+        binascii.hexlify(os.urandom(8)).decode()
+    )
+    return '{}:{}'.format(payload, _session_signature(keys, payload))
+
+
+def verify_session_token(token, keys):
     """
+    校验会话令牌是否有效.
+    """
+    try:
+        payload, signature = token.rsplit(':', 1)
+        prefix, expires, _ = payload.split(':')
+        expires = int(expires)
+    except ValueError:
+        return False
     return (
-        Fernet(keys.private.encode()).decrypt(token.encode()) == keys.secret.encode()
+        prefix == SESSION_PREFIX and expires >= time.time() and
+        hmac.compare_digest(signature, _session_signature(keys, payload))
+    )
+
+
+def peer_proof(token, keys):
+    """
+    生成对等证明.
+    Prove to a peer that sent the given auth token that the keys are known,
+    the proof being bound to this token so that it cannot be replayed.
+    """
+    if isinstance(token, bytes):
+        token = token.decode('utf-8', 'replace')
+    return _session_signature(keys, 'peer:{}'.format(token))
+
+
+def verify_peer_proof(proof, token, keys):
+    """
+    校验对等证明是否有效.
+    """
+    if isinstance(proof, bytes):
+        proof = proof.decode('utf-8', 'replace')
+    if not isinstance(proof, str):
+        return False
+    return hmac.compare_digest(
+        proof.encode('utf-8'), peer_proof(token, keys).encode('utf-8')
     )
 
 
+def verify_auth_token(token, keys):
+    """
+    校验授权令牌是否有效.
+    Both Fernet tokens and session tokens are accepted.
+    """
+    if isinstance(token, bytes):
+        token = token.decode('utf-8', 'replace')
+    if token.startswith(SESSION_PREFIX + ':'):
+        return verify_session_token(token, keys)
+    try:
+        return (
+            _fernet(keys.private).decrypt(token.encode()) == keys.secret.encode()
+        )
+    except InvalidToken:
+        return False
+
+
 def auth_token(keys):
     """
     从给定的私钥和密钥，生成一个令牌.
     """
-    return Fernet(keys.private.encode()).encrypt(keys.secret.encode())
+    return _fernet(keys.private).encrypt(keys.secret.encode())
@@ -0,0 +1,183 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : JSON codec and wire formats module.
+
+The fastest JSON library available is used (orjson, then ujson), the
+standard library json module being the fallback.
+
+Gateways and broker may also talk MessagePack, with integer tags in place
+of the well-known message keys, when the msgpack package is installed.
+"""
+# -*- coding: utf-8 -*-
+import json
+import logging
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("pycots.codec")
+
+# Raised when decoding invalid JSON, whatever the backend.
+DecodeError = ValueError
+
+BACKENDS = OrderedDict()
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    BACKENDS['orjson'] = (
+        lambda obj: orjson.dumps(obj).decode('utf-8'),
+        orjson.loads
+    )
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    BACKENDS['ujson'] = (
+        lambda obj: ujson.dumps(obj, ensure_ascii=False),
+        ujson.loads
+    )
+
+BACKENDS['json'] = (
+    lambda obj: json.dumps(obj, ensure_ascii=False),
+    json.loads
+)
+
+backend = None
+dumps = None
+loads = None
+
+
+def set_backend(name):
+    """
+    Select the JSON library used by `dumps` and `loads`.
+    """
+    global backend, dumps, loads
+    if name not in BACKENDS:
+        raise ValueError(
+            "JSON backend '{}' not available, choose from {}".format(name, list(BACKENDS))
+        )
+    backend = name
+    dumps, loads = BACKENDS[name]
+    logger.debug("Using '{}' JSON backend".format(name))
+
+
+set_backend(next(iter(BACKENDS)))
+
+
+class JsonFormat():
+    """
+    Text JSON wire format, used by default and by browser clients.
+    """
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    @staticmethod
+    def encode(message):
+        return dumps(message)
+
+    @staticmethod
+    def decode(raw):
+        return loads(raw)
+
+
+# Integer tags of message keys and types in the MessagePack format. New
+# entries must be appended to keep existing tags stable.
+FIELDS = (
+    'type', 'uid', 'endpoint', 'data', 'dst', 'src', 'updates', 'uids',
+    'status', 'session', 'nodes', 'token', 'gateway', 'seq'
+)
+TYPES = (
+    'new', 'update', 'out', 'reset', 'batch', 'gateway_out',
+    'subscribe', 'unsubscribe', 'auth', 'snapshot'
+)
+FIELD_TAGS = {field: tag for tag, field in enumerate(FIELDS)}
+TYPE_TAGS = {type_: tag for tag, type_ in enumerate(TYPES)}
+
+
+def _tag(message):
+    tagged = {}
+    for key, value in message.items():
+        if key == 'type':
+            value = TYPE_TAGS.get(value, value)
+        elif key == 'updates':
+            value = [_tag(update) for update in value]
+        tagged[FIELD_TAGS.get(key, key)] = value
+    return tagged
+
+
+def _untag(tagged):
+    message = {}
+    for key, value in tagged.items():
+        if isinstance(key, int) and key < len(FIELDS):
+            key = FIELDS[key]
+        if key == 'type' and isinstance(value, int) and value < len(TYPES):
+            value = TYPES[value]
+        elif key == 'updates':
+            value = [_untag(update) for update in value]
+        message[key] = value
+    return message
+
+
+# msgpack < 1.0 has no strict_map_key option and accepts integer keys
+_UNPACK_OPTIONS = {'raw': False}
+if msgpack is not None and msgpack.version >= (1, 0):
+    _UNPACK_OPTIONS['strict_map_key'] = False
+
+
+class MsgpackFormat():
+    """
+    Binary MessagePack wire format, for gateways to broker links.
+    """
+    name = 'msgpack'
+    subprotocol = 'pycots.msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(message):
+        return msgpack.packb(_tag(message), use_bin_type=True)
+
+    @staticmethod
+    def decode(raw):
+        if isinstance(raw, str):
+            raise DecodeError("Text frame received on a binary link")
+        try:
+            tagged = msgpack.unpackb(raw, **_UNPACK_OPTIONS)
+        except Exception as exc:
+            raise DecodeError("Invalid MessagePack data: {}".format(exc))
+        if not isinstance(tagged, dict):
+            raise DecodeError("Invalid MessagePack message")
+        return _untag(tagged)
+
+
+JSON = JsonFormat
+FORMATS = OrderedDict([('json', JsonFormat)])
+if msgpack is not None:
+    FORMATS['msgpack'] = MsgpackFormat
+
+SUBPROTOCOLS = {
+    fmt.subprotocol: fmt for fmt in FORMATS.values()
+    if fmt.subprotocol is not None
+}
+
+
+def get_format(name):
+    """
+    Return the wire format with the given name.
+    """
+    if name not in FORMATS:
+        raise ValueError(
+            "Wire format '{}' not available, choose from {}".format(name, list(FORMATS))
+        )
+    return FORMATS[name]
@@ -0,0 +1,136 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Websocket client connection manager.
+"""
+# -*- coding: utf-8 -*-
+import random
+import logging
+from tornado import gen
+from tornado.httpclient import HTTPError
+from tornado.iostream import StreamClosedError
+from tornado.websocket import websocket_connect
+
+logger = logging.getLogger("pycots.connection")
+
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+CLOSED = 'closed'
+
+
+class ConnectionManager():
+    """
+    Keep a websocket client connection open.
+
+    Reconnections are delayed by a jittered exponential backoff, so that
+    many clients losing the same server don't retry in lock-step. Pings
+    detect half-open connections. State changes are notified to the
+    callbacks registered with `add_state_callback`.
+    """
+    def __init__(self, url, on_message, subprotocols=None,
+                 backoff_min=1, backoff_max=60, connect_timeout=10,
+                 ping_interval=10, ping_timeout=30):
+        self.url = url
+        self.on_message = on_message
+        self.subprotocols = subprotocols
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.connect_timeout = connect_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self.state = DISCONNECTED
+        self.connection = None
+        self.attempts = 0
+        self._callbacks = []
+
+    def add_state_callback(self, callback):
+        """
+        Register a callback called with the new state on each change.
+        """
+        self._callbacks.append(callback)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        logger.debug("Connection to {}: {} -> {}".format(self.url, self.state, state))
+        self.state = state
+        for callback in self._callbacks:
+            try:
+                callback(state)
+            except Exception:
+                logger.exception("Error in connection state callback")
+
+    def backoff(self):
+        """
+        Return the delay before the next connection attempt ("full jitter").
+        """
+        ceiling = min(self.backoff_max, self.backoff_min * 2 ** self.attempts)
+        return random.uniform(0, ceiling)
+
+    def reset_backoff(self):
+        """
+        Called once the connection is known to be usable (e.g. authenticated).
+        """
+        self.attempts = 0
+
+    @gen.coroutine
+    def run(self):
+        """
+        Connect, read messages and reconnect until `close` is called.
+        """
+        while self.state != CLOSED:
+            self._set_state(CONNECTING)
+            try:
+                self.connection = yield websocket_connect(
+                    self.url,
+                    connect_timeout=self.connect_timeout,
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_timeout,
+                    subprotocols=self.subprotocols
+                )
+            except (OSError, HTTPError, StreamClosedError, gen.TimeoutError) as exc:
+                logger.warning("Cannot connect to {}: {}".format(self.url, exc))
+            else:
+                if self.state == CLOSED:
+                    self.connection.close()
+                    break
+                self._set_state(CONNECTED)
+                while True:
+                    message = yield self.connection.read_message()
+                    if message is None:
+                        break
+                    try:
+                        self.on_message(message)
+                    except Exception:
+                        logger.exception(
+                            "Error handling message from {}".format(self.url)
+                        )
+                logger.warning("Connection to {} lost".format(self.url))
+
+            self.connection = None
+            if self.state == CLOSED:
+                break
+            self._set_state(DISCONNECTED)
+
+            delay = self.backoff()
+            self.attempts += 1
+            logger.info("Reconnecting to {} in {:.1f}s".format(self.url, delay))
+            yield gen.sleep(delay)
+
+    def write_message(self, message, binary=False):
+        """
+        Send a message, return a Future resolved once written.
+        """
+        return self.connection.write_message(message, binary=binary)
+
+    def close(self):
+        """
+        Close the connection and stop reconnecting.
+        """
+        self._set_state(CLOSED)
+        if self.connection is not None:
+            self.connection.close()
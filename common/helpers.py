@@ -10,6 +10,8 @@ import logging
 import signal
 from functools import partial
 import tornado
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
 from tornado.options import define, options
 
 from pycots.common.auth import DEFAULT_KEY_FILENAME
@@ -69,14 +71,22 @@ def signal_handler(server, app_close, sig, frame):
     _ioloop.add_callback_from_signal(shutdown)
 
 
-def start_application(app, port=None, close_client=False):
+def start_application(app, port=None, close_client=False, reuse_port=False):
     """
     Start a tornado application.
+
+    With `reuse_port`, the listening socket is bound with SO_REUSEPORT so
+    that several processes share the port, the kernel spreading incoming
+    connections among them.
     """
     _ioloop = tornado.ioloop.IOLoop.current()
     _server = None
     if port is not None:
-        _server = app.listen(port)
+        if reuse_port:
+            _server = HTTPServer(app)
+            _server.add_sockets(bind_sockets(port, reuse_port=True))
+        else:
+            _server = app.listen(port)
 
     if not close_client:
         app.close_client = None
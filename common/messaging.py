@@ -6,11 +6,16 @@ Updated at: 2018-06
 Content : messaging utility module.
 """
 # -*- coding: utf-8 -*-
-import json
 import logging
+from pycots.common import codec
 
 logger = logging.getLogger("pycots.messaging")
 
+MESSAGE_TYPES = (
+    'new', 'update', 'out', 'reset', 'batch', 'subscribe', 'unsubscribe',
+    'auth', 'snapshot'
+)
+
 
 def check_broker_data(data):
     """"
@@ -45,41 +50,60 @@ def check_broker_data(data):
 class Message():
     """
     Utility class for generating and parsing service messages.
+
+    Messages are JSON text unless another wire format (see `codec.FORMATS`)
+    is given with the `fmt` argument, or left unencoded with `fmt=None`.
+    Messages of gateways carry their sequence number (`seq`) when given.
     """
     @staticmethod
-    def serialize(message):
-        return json.dumps(message, ensure_ascii=False)
+    def serialize(message, fmt=codec.JSON, seq=None):
+        if seq is not None:
+            message['seq'] = seq
+        if fmt is None:
+            return message
+        return fmt.encode(message)
 
     @staticmethod
-    def new_node(uid, dst="all"):
+    def new_node(uid, dst="all", fmt=codec.JSON, seq=None):
         """
         生成新节点消息. 
         Generate a text message indicating a new node.
         """
         return Message.serialize({
             'type': 'new', 'uid': uid, 'dst': dst
-        })
+        }, fmt, seq)
 
     @staticmethod
-    def out_node(uid):
+    def out_node(uid, fmt=codec.JSON, seq=None):
         """
         删除节点消息. 
         Generate a text message indicating a node to remove.
         """
         return Message.serialize({
             'type': 'out', 'uid': uid
-        })
+        }, fmt, seq)
+
+    @staticmethod
+    def gateway_out(uids, fmt=codec.JSON):
+        """
+        网关断开消息.
+        Generate a text message indicating that all the given nodes are
+        gone along with their gateway.
+        """
+        return Message.serialize({
+            'type': 'gateway_out', 'uids': uids
+        }, fmt)
 
     @staticmethod
-    def reset_node(uid):
+    def reset_node(uid, fmt=codec.JSON, seq=None):
         """
         重置节点消息. 
         Generate a text message indicating a node reset.
         """
-        return Message.serialize({'type': 'reset', 'uid': uid})
+        return Message.serialize({'type': 'reset', 'uid': uid}, fmt, seq)
 
     @staticmethod
-    def update_node(uid, endpoint, data, dst="all"):
+    def update_node(uid, endpoint, data, dst="all", fmt=codec.JSON, seq=None):
         """
         更新节点消息. 
         Generate a text message indicating a node update.
@@ -90,7 +114,57 @@ class Message():
             'endpoint': endpoint,
             'data': data,
             'dst': dst
-        })
+        }, fmt, seq)
+
+    @staticmethod
+    def batch(updates, dst="all", fmt=codec.JSON):
+        """
+        批量更新节点消息.
+        Generate a text message grouping several node updates, each update
+        being a dict with 'uid', 'endpoint' and 'data' keys, and 'seq' for
+        updates of gateways.
+        """
+        return Message.serialize({
+            'type': 'batch',
+            'updates': updates,
+            'dst': dst
+        }, fmt)
+
+    @staticmethod
+    def snapshot(nodes, dst="all", fmt=codec.JSON, seq=None):
+        """
+        节点状态快照消息.
+        Generate a text message with the state of several nodes, as a dict
+        of resources ({endpoint: data}) keyed by node uid.
+        """
+        return Message.serialize({
+            'type': 'snapshot',
+            'nodes': nodes,
+            'dst': dst
+        }, fmt, seq)
+
+    @staticmethod
+    def auth_request(token, gateway=None, seq=None, fmt=codec.JSON):
+        """
+        认证请求消息.
+        Generate the authentication message of a gateway, with its id and
+        the lowest sequence number it can resume from.
+        """
+        return Message.serialize({
+            'type': 'auth', 'token': token, 'gateway': gateway
+        }, fmt, seq)
+
+    @staticmethod
+    def auth(status, session=None, fmt=codec.JSON, seq=None):
+        """
+        认证结果消息.
+        Generate a message telling a gateway the result of its
+        authentication, with a session token for its next connections and
+        the last sequence number received from it, if any.
+        """
+        return Message.serialize({
+            'type': 'auth', 'status': status, 'session': session
+        }, fmt, seq)
 
     @staticmethod
     def discover_node():
@@ -101,20 +175,20 @@ class Message():
         return Message.serialize({'request': 'discover'})
 
     @staticmethod
-    def check_message(raw):
+    def check_message(raw, fmt=codec.JSON):
         """
         消息格式检查. 
         Verify a received message is correctly formatted.
         """
         reason = None
         try:
-            message = json.loads(raw)
+            message = fmt.decode(raw)
         except TypeError as exc:
             logger.warning(exc)
             reason = "Invalid message '{}'.".format(raw)
             message = None
-        except json.JSONDecodeError:
-            reason = ("Invalid message received '{}'. Only JSON format is supported.".format(raw))
+        except codec.DecodeError:
+            reason = ("Invalid message received '{}'. Only {} format is supported.".format(raw, fmt.name))
             message = None
 
         if message is not None:
@@ -122,8 +196,7 @@ class Message():
                 reason = "Invalid message '{}'.".format(message)
             elif 'type' not in message and 'data' not in message:
                 reason = "Invalid message '{}'.".format(message)
-            elif ( message['type'] != 'new' and message['type'] != 'update'
-                   and message['type'] != 'out' and message['type'] != 'reset'):
+            elif message['type'] not in MESSAGE_TYPES:
                 reason = "Invalid message type '{}'.".format(message['type'])
 
         if reason is not None:
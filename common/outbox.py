@@ -0,0 +1,196 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Bounded outbound message queue.
+"""
+# -*- coding: utf-8 -*-
+import logging
+import itertools
+from collections import OrderedDict
+from tornado import gen
+from tornado.locks import Condition, Event
+
+logger = logging.getLogger("pycots.outbox")
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, COALESCE)
+
+
+class Outbox():
+    """
+    Bounded FIFO of messages written one after the other with `send`.
+
+    `send(message)` must return a Future resolved once the message is
+    written, so that a slow peer slows the queue down instead of letting
+    the transport buffer without bound.
+
+    When the queue holds `maxsize` messages, the policy applies:
+    - drop-oldest: the oldest message is dropped,
+    - coalesce: a message put with the key of a queued one replaces it,
+      otherwise the oldest message without key is dropped. Keyed messages
+      are never dropped, so the latest value of each key is always sent.
+
+    Messages put with `packable=True` may be grouped, up to `batch_size`
+    consecutive ones, by `pack(messages)` which returns the message to
+    send. `linger` (in s) is the time waited for a batch to fill up.
+    """
+    def __init__(self, send, maxsize=1000, policy=COALESCE,
+                 batch_size=1, pack=None, linger=0):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Invalid outbox policy '{}', choose from {}".format(policy, POLICIES)
+            )
+        self.send = send
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.pack = pack
+        self.linger = linger
+
+        self._queue = OrderedDict()     # entry key -> (message, packable)
+        self._ids = itertools.count()
+        self._not_empty = Event()
+        self._not_full = Condition()
+        self._running = Event()
+        self._draining = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def metrics(self):
+        """
+        Return the queue counters.
+        """
+        return {
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'policy': self.policy,
+            'running': self._running.is_set(),
+        }
+
+    def _drop_oldest(self, keyed=True):
+        for entry in self._queue:
+            if keyed or entry[0] is None:
+                self._queue.pop(entry)
+                self.dropped += 1
+                return
+
+    @gen.coroutine
+    def put(self, message, key=None, packable=False):
+        """
+        Queue a message, with an optional coalescing key.
+        """
+        if self.policy == COALESCE and key is not None:
+            if self._queue.pop((key, None), None) is not None:
+                self.coalesced += 1
+        if len(self._queue) >= self.maxsize:
+            if self.policy == DROP_OLDEST:
+                self._drop_oldest()
+            elif self.policy == COALESCE:
+                # Keyed messages are never dropped, so the queue may hold
+                # more than maxsize messages when there are more keys.
+                self._drop_oldest(keyed=False)
+
+        if key is not None and self.policy == COALESCE:
+            entry = (key, None)
+        else:
+            entry = (None, next(self._ids))
+        self._queue[entry] = (message, packable)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._not_empty.set()
+        if not self._draining:
+            self._draining = True
+            self._drain()
+
+    @gen.coroutine
+    def join(self, depth=0):
+        """
+        Wait until at most `depth` messages are queued.
+        """
+        while len(self._queue) > depth:
+            yield self._not_full.wait()
+
+    def start(self):
+        """
+        Start (or resume) sending queued messages.
+        """
+        self._running.set()
+
+    def stop(self):
+        """
+        Stop sending, messages are kept queued until `start` is called.
+        """
+        self._running.clear()
+
+    def clear(self):
+        """
+        Drop all queued messages.
+        """
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self._not_full.notify_all()
+
+    def _take(self):
+        entry, (message, packable) = self._queue.popitem(last=False)
+        taken = [(entry, message, packable)]
+        if packable and self.pack is not None:
+            while self._queue and len(taken) < self.batch_size:
+                next_entry = next(iter(self._queue))
+                next_message, next_packable = self._queue[next_entry]
+                if not next_packable:
+                    break
+                self._queue.pop(next_entry)
+                taken.append((next_entry, next_message, True))
+            return taken, self.pack([item[1] for item in taken])
+        return taken, message
+
+    def _requeue(self, taken):
+        """
+        Put back messages that could not be sent, unless superseded.
+        """
+        for entry, message, packable in reversed(taken):
+            if entry in self._queue:
+                continue
+            self._queue[entry] = (message, packable)
+            self._queue.move_to_end(entry, last=False)
+
+    @gen.coroutine
+    def _drain(self):
+        try:
+            while True:
+                yield self._running.wait()
+                if not self._queue:
+                    self._not_empty.clear()
+                    yield self._not_empty.wait()
+                    continue
+
+                if self.linger and len(self._queue) < self.batch_size:
+                    _, packable = next(iter(self._queue.values()))
+                    if packable:
+                        yield gen.sleep(self.linger)
+                        if not self._queue:
+                            continue
+
+                taken, message = self._take()
+                self._not_full.notify_all()
+                try:
+                    yield self.send(message)
+                except Exception as exc:
+                    logger.debug("Cannot send message, requeued: {}".format(exc))
+                    self._requeue(taken)
+                    self.stop()
+                else:
+                    self.sent += len(taken)
+        finally:
+            self._draining = False
@@ -7,3 +7,6 @@ Updated at: 2018-06
 # -*- coding: utf-8 -*-
 from .gateway import GatewayBase
 from .node import Node
+from .expiry import NodeExpiry
+from .throttle import UpdateThrottle
+from .options import define_gateway_options
@@ -0,0 +1,59 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Expiry index of managed nodes.
+"""
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import time
+
+logger = logging.getLogger("pycots.gw.base.expiry")
+
+
+class NodeExpiry():
+    """
+    Min-heap of node deadlines (`last_seen + max_time`).
+
+    Deadlines are refreshed lazily: `Node.update_last_seen` only touches the
+    node, and an entry popped from the heap whose node has been seen again
+    meanwhile is pushed back with its new deadline. A check therefore only
+    visits entries that are due.
+    """
+    def __init__(self, max_time):
+        self.max_time = max_time
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, node):
+        """
+        Start tracking the given node.
+        """
+        heapq.heappush(self._heap, (node.last_seen + self.max_time, node.uid))
+
+    def expired(self, nodes, now=None):
+        """
+        Return the nodes, among `nodes` (a dict keyed by uid), that have not
+        been seen for more than `max_time` seconds.
+        """
+        if now is None:
+            now = time.time()
+
+        result = []
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            _, uid = heapq.heappop(heap)
+            node = nodes.get(uid)
+            if node is None:
+                # Node already removed
+                continue
+            deadline = node.last_seen + self.max_time
+            if now > deadline:
+                result.append(node)
+            else:
+                heapq.heappush(heap, (deadline, uid))
+        return result
@@ -6,14 +6,18 @@ Updated at: 2018-06
 Content : Base class for gateways. 
 """
 # -*- coding: utf-8 -*-
-import json
+import uuid
 import logging
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from tornado import web, gen
-from tornado.websocket import websocket_connect
+from pycots.common import codec
 from pycots.common.auth import auth_token
+from pycots.common.connection import ConnectionManager, CONNECTED
+from pycots.common.outbox import Outbox
 from pycots.common.messaging import check_broker_data, Message
-from pycots.gateway.settings import LOG_LEVEL
+from pycots.gateway.settings import LOG_LEVEL, GATEWAY_MAX_TOMBSTONES
+from .throttle import UpdateThrottle, parse_rate_limits
 
 logger = logging.getLogger("pycots.gw.base.gateway")
 logger.setLevel(LOG_LEVEL)
@@ -40,12 +44,18 @@ class GatewayBaseMixin():
         """
         node.set_resource_value('protocol', self.PROTOCOL)
         self.nodes.update({node.uid: node})
-        self.send_to_broker(Message.new_node(node.uid))
+        self.tombstones.pop(node.uid, None)
+        node.version = self.next_seq()
+        self.send_to_broker(
+            Message.new_node(node.uid, fmt=None, seq=node.version),
+            key=(node.uid, None, 'all')
+        )
         # for res, value in node.resources.items():
         #     self.send_to_broker(Message.update_node(node.uid, res, value))
         yield self.discover_node(node)
 
 
+    @gen.coroutine
     def reset_node(self, node, default_resources={}):
         """
         Reset a node: clear the current resource and reinitialize them.
@@ -54,8 +64,12 @@ class GatewayBaseMixin():
         node.set_resource_value('protocol', self.PROTOCOL)
         for resource, value in default_resources.items():
             node.set_resource_value(resource, value)
-        self.send_to_broker(Message.reset_node(node.uid))
-        self.discover_node(node)
+        self.throttle.forget(node.uid)
+        node.version = self.next_seq()
+        self.send_to_broker(
+            Message.reset_node(node.uid, fmt=None, seq=node.version)
+        )
+        yield self.discover_node(node)
 
 
     def remove_node(self, node):
@@ -63,8 +77,39 @@ class GatewayBaseMixin():
         Remove the given node from known nodes and notify the broker.
         """
         self.nodes.pop(node.uid)
+        self.throttle.forget(node.uid)
         logger.debug("Remaining nodes {}".format(self.nodes))
-        self.send_to_broker(Message.out_node(node.uid))
+        self.send_node_out(node.uid)
+
+
+    def send_node_out(self, uid):
+        """
+        Notify the broker that a node is gone, and remember it for the delta
+        synchronizations to come.
+        """
+        seq = self.next_seq()
+        self.tombstones.pop(uid, None)
+        self.tombstones[uid] = seq
+        if len(self.tombstones) > GATEWAY_MAX_TOMBSTONES:
+            # Deltas can only resume from marks covering this removal
+            _, pruned = self.tombstones.popitem(last=False)
+            self.resume_floor = max(self.resume_floor, pruned)
+        self.send_to_broker(
+            Message.out_node(uid, fmt=None, seq=seq),
+            key=(uid, None, 'all')
+        )
+
+
+    def next_seq(self):
+        """
+        Return the sequence number of the next message sent to the broker.
+
+        Numbers are given when messages are queued, so that queued messages
+        are sent in sequence order: the last number received by the broker
+        tells what it has received.
+        """
+        self.seq += 1
+        return self.seq
 
 
     def get_node(self, uid):
@@ -83,26 +128,133 @@ class GatewayBaseMixin():
             "Sending data received from node '{}': '{}', '{}'.".format(node, resource, value)
         )
         node.set_resource_value(resource, value)
-        self.send_to_broker(
-            Message.update_node(node.uid, resource, value)
+        if self.throttle.limits(resource):
+            self.throttle.submit(node.uid, resource)
+        else:
+            self.send_update(node.uid, resource, value)
+
+
+    def send_latest_update(self, uid, resource):
+        """
+        Send the current value of a rate limited node resource.
+        """
+        node = self.nodes.get(uid)
+        if node is not None and resource in node.resources:
+            self.send_update(uid, resource, node.resources[resource])
+
+
+    def send_update(self, uid, resource, value, dst='all'):
+        """
+        Queue a node update for the broker. Only the latest value of a
+        resource is kept while the update is queued.
+        """
+        key = (uid, resource, dst)
+        if dst == 'all':
+            seq = self.next_seq()
+            node = self.nodes.get(uid)
+            if node is not None:
+                node.versions[resource] = seq
+            # Encoded when sent, grouped with other updates in batches
+            update = {'uid': uid, 'endpoint': resource, 'data': value, 'seq': seq}
+            return self.broker_outbox.put(update, key=key, packable=True)
+        return self.send_to_broker(
+            Message.update_node(uid, resource, value, dst=dst, fmt=None),
+            key=key
         )
 
 
+    def pack_updates(self, updates):
+        """
+        Group queued node updates into one broker message.
+        """
+        if len(updates) == 1:
+            update = updates[0]
+            return Message.update_node(
+                update['uid'], update['endpoint'], update['data'],
+                fmt=None, seq=update['seq']
+            )
+        return Message.batch(updates, fmt=None)
+
+
     @gen.coroutine
-    def fetch_nodes_cache(self, client):
+    def fetch_nodes_cache(self, client, since=None):
         """
         Send cached nodes information to a given client.
         :param client: the ID of the client
+        :param since: last sequence number received by the broker, only
+        changes made after it are sent
         """
         logger.debug(
-            "Fetching cached information of registered nodes '{}'.".format(self.nodes)
+            "Fetching cached information of {} registered nodes.".format(len(self.nodes))
         )
-        for node in self.nodes.values():
-            self.send_to_broker(Message.new_node(node.uid, dst=client))
-            for resource, value in node.resources.items():
-                self.send_to_broker(
-                    Message.update_node(node.uid, resource, value, dst=client)
+        broker = self.broker
+        chunk_size = self.options.snapshot_chunk_size
+        for nodes in self.iter_snapshots(chunk_size, since):
+            seq = None
+            if client == 'all':
+                # The snapshot is now the last message with these nodes
+                seq = self.next_seq()
+                for node in nodes:
+                    node.version = seq
+                    node.versions = dict.fromkeys(node.resources, seq)
+            depth = len(self.broker_outbox)
+            self.send_to_broker(
+                Message.snapshot(
+                    {node.uid: dict(node.resources) for node in nodes},
+                    dst=client, fmt=None, seq=seq
                 )
+            )
+            # Build the next chunk once the queue is drained back, so that
+            # only a chunk or two are held in memory.
+            yield self.broker_outbox.join(max(depth, 1))
+            if self.broker is not broker:
+                # Link lost meanwhile, it is replayed on reconnection
+                return
+
+        if since is None:
+            return
+
+        # Resources changed since, on nodes already known by the broker
+        depth = len(self.broker_outbox)
+        count = 0
+        for node in list(self.nodes.values()):
+            if node.version > since or node.uid not in self.nodes:
+                continue
+            for resource, value in node.resources.items():
+                if node.versions.get(resource, 0) > since:
+                    self.send_update(node.uid, resource, value)
+                    count += 1
+            if count >= chunk_size:
+                yield self.broker_outbox.join(max(depth, 1))
+                if self.broker is not broker:
+                    return
+                depth = len(self.broker_outbox)
+                count = 0
+
+        # Nodes removed since
+        for uid, seq in list(self.tombstones.items()):
+            if seq > since and uid not in self.nodes:
+                self.send_node_out(uid)
+
+
+    def iter_snapshots(self, chunk_size, since=None):
+        """
+        Generate the nodes, by chunks of `chunk_size` nodes, whose whole
+        state was last sent after `since` (all the nodes by default).
+        """
+        chunk = []
+        for node in list(self.nodes.values()):
+            if node.uid not in self.nodes:
+                # Removed meanwhile
+                continue
+            if since is not None and node.version <= since:
+                continue
+            chunk.append(node)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
     def close_client(self):
@@ -110,42 +262,114 @@ class GatewayBaseMixin():
         Close client websocket
         """
         logger.warning("Closing connection with broker.")
-        self.broker.close()
+        if self.broker_link is not None:
+            self.broker_link.close()
+        elif self.broker is not None:
+            self.broker.close()
 
 
     @gen.coroutine
     def create_broker_connection(self, url):
         """
-        Create an asynchronous connection to the broker.
+        Create an asynchronous connection to the broker, kept open by a
+        connection manager.
         """
-        while True:
-            try:
-                self.broker = yield websocket_connect(url)
-            except ConnectionRefusedError:
-                logger.warning("Cannot connect, retrying in 3s")
-            else:
-                logger.info("Connected to broker, sending auth token")
-                self.broker.write_message(auth_token(self.keys))
-                yield gen.sleep(1)
-                self.fetch_nodes_cache('all')
-                while True:
-                    message = yield self.broker.read_message()
-                    if message is None:
-                        logger.warning("Connection with broker lost.")
-                        break
-                    self.on_broker_message(message)
+        try:
+            fmt = codec.get_format(self.options.broker_format)
+        except ValueError as exc:
+            logger.error("{}, falling back to JSON".format(exc))
+            fmt = codec.JSON
+
+        self.broker_link = ConnectionManager(
+            url, self.on_broker_message,
+            subprotocols=[fmt.subprotocol] if fmt.subprotocol else None,
+            backoff_min=self.options.broker_backoff_min,
+            backoff_max=self.options.broker_backoff_max,
+            connect_timeout=self.options.broker_connect_timeout,
+            ping_interval=self.options.broker_ping_interval,
+            ping_timeout=self.options.broker_ping_timeout
+        )
+        self.broker_link.add_state_callback(self.on_broker_state)
+        yield self.broker_link.run()
 
-            yield gen.sleep(3)
 
+    def on_broker_state(self, state):
+        """
+        Handle a state change of the broker connection.
+        """
+        if state == CONNECTED:
+            self.broker = self.broker_link.connection
+            # The broker selects the wire format among the proposed ones
+            self.broker_format = codec.SUBPROTOCOLS.get(
+                self.broker.selected_subprotocol, codec.JSON
+            )
+            logger.info(
+                "Connected to broker ({} format), sending auth token".format(
+                    self.broker_format.name
+                )
+            )
+            self.broker_authenticated = False
+            if self.broker_outbox.dropped != self.synced_drops:
+                # Messages were lost, the broker has to get everything again
+                self.synced_drops = self.broker_outbox.dropped
+                self.resume_floor = self.seq + 1
+            self.broker.write_message(
+                Message.auth_request(
+                    self.broker_session or auth_token(self.keys).decode(),
+                    self.gateway_id, self.resume_floor, fmt=self.broker_format
+                ),
+                binary=self.broker_format.binary
+            )
+        elif self.broker is not None:
+            logger.warning("Connection with broker lost.")
+            if not self.broker_authenticated:
+                # Session token refused (expired, keys changed)
+                self.broker_session = None
+            self.broker_authenticated = False
+            self.broker = None
+            # Messages are kept queued until the link recovers
+            self.broker_outbox.stop()
+
+
+    def send_to_broker(self, message, key=None):
+        """
+        Queue a message for the parent broker, built with `fmt=None`: it is
+        encoded when written, in the format selected by the broker. A queued
+        message with the same key is replaced.
 
-    @gen.coroutine
-    def send_to_broker(self, message):
+        Return a Future resolved once the message is queued.
         """
-        Send a string message to the parent broker.
+        return self.broker_outbox.put(message, key=key)
+
+
+    def write_to_broker(self, message):
         """
-        if self.broker is not None:
-            logger.debug("Sending message '{}' to broker.".format(message))
-            self.broker.write_message(message)
+        Write a message to the broker, return a Future resolved once written.
+        """
+        logger.debug("Sending message '{}' to broker.".format(message))
+        return self.broker.write_message(
+            self.broker_format.encode(message), binary=self.broker_format.binary
+        )
+
+
+    def broker_metrics(self):
+        """
+        Return the state of the broker link and of its outbound queue.
+        """
+        metrics = self.broker_outbox.metrics()
+        metrics.update({
+            'connected': self.broker is not None,
+            'authenticated': self.broker_authenticated,
+            'nodes': len(self.nodes),
+        })
+        return metrics
+
+
+    def metrics(self):
+        """
+        Return the metrics reported on '/metrics'.
+        """
+        return self.broker_metrics()
 
 
     def on_broker_message(self, message):
@@ -153,9 +377,35 @@ class GatewayBaseMixin():
         Handle a message received from the broker websocket.
         """
         logger.debug("Handling message '{}' received from broker.".format(message))
-        message = json.loads(message)
-
-        if message['type'] == "new":
+        message = self.broker_format.decode(message)
+
+        if message['type'] == "auth":
+            if self.broker_authenticated:
+                # Only expected as the reply to the auth request
+                logger.warning("Unexpected auth message received from broker")
+                return
+            # Authentication handshake result, node states are streamed as
+            # soon as the broker accepted the token.
+            if message.get('status') == "ok":
+                logger.info("Authenticated by broker")
+                self.broker_authenticated = True
+                self.broker_link.reset_backoff()
+                self.broker_session = message.get('session')
+                self.broker_outbox.start()
+                # Only what the broker missed is sent when it knows this
+                # gateway, everything otherwise.
+                mark = message.get('seq')
+                if mark is not None:
+                    while self.tombstones:
+                        uid, seq = next(iter(self.tombstones.items()))
+                        if seq > mark:
+                            break
+                        self.tombstones.pop(uid)
+                self.fetch_nodes_cache('all', since=mark)
+            else:
+                logger.warning("Authentication refused by broker")
+                self.broker_session = None
+        elif message['type'] == "new":
             # Received when a new client connects => fetching the nodes
             # in controller's cache
             self.fetch_nodes_cache(message['src'])
@@ -169,16 +419,23 @@ class GatewayBaseMixin():
             uid = data['uid']
             endpoint = data['endpoint']
             payload = data['payload']
-            for node in self.nodes.values():
-                if node.uid == uid:
-                    self.update_node_resource(node, endpoint, payload)
-                    break
+            node = self.nodes.get(uid)
+            if node is not None:
+                self.update_node_resource(node, endpoint, payload)
         else:
             logger.debug(
-                "Invalid data received from broker '{}'." .format(message['data'])
+                "Invalid data received from broker '{}'." .format(message.get('data'))
             )
 
 
+class GatewayMetricsHandler(web.RequestHandler):
+    """
+    Report the metrics of the gateway.
+    """
+    def get(self):
+        self.write(self.application.metrics())
+
+
 class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
     """
     Base gateway application.
@@ -192,13 +449,38 @@ class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
         self.options = options
         self.nodes = {}
         self.broker = None
+        self.broker_link = None
+        self.broker_format = codec.JSON
+        self.broker_session = None
+        self.broker_authenticated = False
         self.keys = keys
+        # Messages sent to the broker are numbered, for delta
+        # synchronizations on reconnection. Numbers restart with the
+        # process, and so does the gateway id.
+        self.gateway_id = uuid.uuid4().hex
+        self.seq = 0
+        self.resume_floor = 0
+        self.synced_drops = 0
+        self.tombstones = OrderedDict()     # removed node uid -> seq
+        batching = options.batch_window > 0
+        self.broker_outbox = Outbox(
+            self.write_to_broker,
+            maxsize=options.broker_queue_size,
+            policy=options.broker_queue_policy,
+            batch_size=options.batch_size if batching else 1,
+            pack=self.pack_updates,
+            linger=options.batch_window / 1000 if batching else 0
+        )
+        self.throttle = UpdateThrottle(
+            parse_rate_limits(options.rate_limits), self.send_latest_update
+        )
         settings = {'debug': True}
 
         # Create connection to broker @chijy update
         # self.create_broker_connection(
         #     "ws://{}:{}/gw".format(options.broker_host, options.broker_port)
         # )
+        handlers = handlers + [(r"/metrics", GatewayMetricsHandler)]
         super().__init__(handlers, **settings)
         logger.debug('Base Gateway application started')
 
@@ -7,6 +7,7 @@ Content : Class for managed node.
 """
 # -*- coding: utf-8 -*-
 import logging
+import sys
 import time
 
 logger = logging.getLogger("pycots.gw.base.node")
@@ -15,11 +16,23 @@ logger = logging.getLogger("pycots.gw.base.node")
 class Node():
     """
     Class for managed nodes.
+
+    Nodes use `__slots__` and interned resource names so that large node
+    populations don't pay for a per-instance `__dict__` nor for a copy of
+    each resource name per node.
+
+    `version` is the sequence number of the last message sent to the broker
+    with the whole node state (new, reset, snapshot), and `versions` the
+    sequence number of the last message sent with each resource.
     """
+    __slots__ = ('uid', 'last_seen', 'resources', 'version', 'versions')
+
     def __init__(self, uid, **default_resources):
         self.uid = uid
         self.last_seen = time.time()
         self.resources = default_resources
+        self.version = 0
+        self.versions = {}
 
     def __eq__(self, other):
         return self.uid == other.uid
@@ -35,9 +48,9 @@ class Node():
 
     def set_resource_value(self, resource, value):
         if resource not in self.resources:
-            self.resources.update({resource: value})
-        else:
-            self.resources[resource] = value
+            resource = sys.intern(resource)
+        self.resources[resource] = value
 
     def clear_resources(self):
         self.resources = {}
+        self.versions = {}
@@ -0,0 +1,81 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Command line options shared by all gateways.
+"""
+# -*- coding: utf-8 -*-
+from tornado.options import define, options
+from pycots.gateway.settings import (
+    GATEWAY_BATCH_WINDOW, GATEWAY_BATCH_SIZE, GATEWAY_BROKER_FORMAT,
+    GATEWAY_BACKOFF_MIN, GATEWAY_BACKOFF_MAX, GATEWAY_CONNECT_TIMEOUT,
+    GATEWAY_PING_INTERVAL, GATEWAY_PING_TIMEOUT, GATEWAY_QUEUE_SIZE,
+    GATEWAY_QUEUE_POLICY, GATEWAY_RATE_LIMITS, GATEWAY_SNAPSHOT_CHUNK
+)
+
+
+def define_gateway_options():
+    """
+    Define the command line options common to all gateway applications.
+    """
+    if not hasattr(options, "batch_window"):
+        define(
+            "batch_window", default=GATEWAY_BATCH_WINDOW,
+            help="Time window (in ms) for grouping node updates sent to the broker, 0 to disable"
+        )
+    if not hasattr(options, "batch_size"):
+        define(
+            "batch_size", default=GATEWAY_BATCH_SIZE,
+            help="Maximum number of node updates grouped in one broker message"
+        )
+    if not hasattr(options, "broker_format"):
+        define(
+            "broker_format", default=GATEWAY_BROKER_FORMAT,
+            help="Wire format proposed to the broker: 'json' or 'msgpack'"
+        )
+    if not hasattr(options, "broker_backoff_min"):
+        define(
+            "broker_backoff_min", default=GATEWAY_BACKOFF_MIN,
+            help="Initial broker reconnection backoff (in s)"
+        )
+    if not hasattr(options, "broker_backoff_max"):
+        define(
+            "broker_backoff_max", default=GATEWAY_BACKOFF_MAX,
+            help="Maximum broker reconnection backoff (in s)"
+        )
+    if not hasattr(options, "broker_connect_timeout"):
+        define(
+            "broker_connect_timeout", default=GATEWAY_CONNECT_TIMEOUT,
+            help="Broker connection timeout (in s)"
+        )
+    if not hasattr(options, "broker_ping_interval"):
+        define(
+            "broker_ping_interval", default=GATEWAY_PING_INTERVAL,
+            help="Interval (in s) between pings sent to the broker"
+        )
+    if not hasattr(options, "broker_ping_timeout"):
+        define(
+            "broker_ping_timeout", default=GATEWAY_PING_TIMEOUT,
+            help="Close the broker connection after this time (in s) without pong"
+        )
+    if not hasattr(options, "broker_queue_size"):
+        define(
+            "broker_queue_size", default=GATEWAY_QUEUE_SIZE,
+            help="Maximum number of messages queued for the broker"
+        )
+    if not hasattr(options, "broker_queue_policy"):
+        define(
+            "broker_queue_policy", default=GATEWAY_QUEUE_POLICY,
+            help="Policy when the broker queue is full: 'drop-oldest' or 'coalesce'"
+        )
+    if not hasattr(options, "rate_limits"):
+        define(
+            "rate_limits", default=GATEWAY_RATE_LIMITS,
+            help="Maximum update rate (in Hz) of endpoints sent to the broker, e.g. 'imu:10,temp:1'"
+        )
+    if not hasattr(options, "snapshot_chunk_size"):
+        define(
+            "snapshot_chunk_size", default=GATEWAY_SNAPSHOT_CHUNK,
+            help="Maximum number of nodes in a snapshot message sent to the broker"
+        )
@@ -0,0 +1,90 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Rate limiting of node updates sent to the broker.
+"""
+# -*- coding: utf-8 -*-
+import logging
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger("pycots.gw.base.throttle")
+
+
+def parse_rate_limits(spec):
+    """
+    Parse rate limits given as 'endpoint:hz,...' (e.g. 'imu:10,temp:1')
+    into a dict of minimum intervals (in s) keyed by endpoint.
+    """
+    intervals = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        endpoint, _, rate = item.rpartition(':')
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = 0
+        if not endpoint or rate <= 0:
+            raise ValueError("Invalid rate limit '{}', expected 'endpoint:hz'".format(item))
+        intervals[endpoint] = 1 / rate
+    return intervals
+
+
+class UpdateThrottle():
+    """
+    Send updates of rate limited endpoints at most once per interval.
+
+    Updates received within the interval are not sent, only the last one:
+    `send(uid, endpoint)` is called when the interval ends and must send the
+    current value of the resource, so that the final state is never lost.
+    """
+    def __init__(self, intervals, send):
+        self.intervals = intervals
+        self.send = send
+        self._state = {}    # uid -> {endpoint: [last sent time, timeout]}
+
+    def limits(self, endpoint):
+        """
+        Return True if updates of the given endpoint are rate limited.
+        """
+        return endpoint in self.intervals
+
+    def submit(self, uid, endpoint):
+        """
+        Send the new value of a node resource, now or when its interval ends.
+        """
+        now = IOLoop.current().time()
+        resources = self._state.setdefault(uid, {})
+        entry = resources.get(endpoint)
+        if entry is None:
+            resources[endpoint] = [now, None]
+            self.send(uid, endpoint)
+            return
+
+        last, timeout = entry
+        if timeout is not None:
+            # Already scheduled, the latest value will be sent
+            return
+        due = last + self.intervals[endpoint]
+        if now >= due:
+            entry[0] = now
+            self.send(uid, endpoint)
+        else:
+            entry[1] = IOLoop.current().call_at(due, self._flush, uid, endpoint)
+
+    def _flush(self, uid, endpoint):
+        entry = self._state[uid][endpoint]
+        entry[0] = IOLoop.current().time()
+        entry[1] = None
+        self.send(uid, endpoint)
+
+    def forget(self, uid):
+        """
+        Drop the state of a node, pending updates are not sent.
+        """
+        for _, timeout in self._state.pop(uid, {}).values():
+            if timeout is not None:
+                IOLoop.current().remove_timeout(timeout)
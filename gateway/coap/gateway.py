@@ -7,15 +7,17 @@ Content : CoAP gateway tornado application module.
 """
 # -*- coding: utf-8 -*-
 import logging
-import time
 import uuid
 import asyncio
 from tornado import gen
 from tornado.ioloop import PeriodicCallback
 import aiocoap
 import aiocoap.resource as resource
-from pycots.gateway.base import GatewayBase, Node
-from pycots.gateway.settings import COAP_GATEWAY_HOST, LOG_LEVEL
+from pycots.gateway.base import GatewayBase, Node, NodeExpiry
+from pycots.gateway.settings import (
+    COAP_GATEWAY_HOST, COAP_NODE_MAX_REQUESTS, COAP_CLIENT_MAX_FAILURES,
+    COAP_REQUEST_TIMEOUT, COAP_MAX_DISCOVERIES, LOG_LEVEL
+)
 
 logger = logging.getLogger("pycots.gw.coap")
 logger.setLevel(LOG_LEVEL)
@@ -26,26 +28,99 @@ def _coap_endpoints(link_header):
     return link.split(',')
 
 
-@gen.coroutine
-def _coap_resource(url, method=aiocoap.Code.GET, payload=b''):
-    protocol = yield from aiocoap.Context.create_client_context()
-    request = aiocoap.Message(
-        code=method, payload=payload
-    )
-    request.set_request_uri(url)
-    try:
-        response = yield from protocol.request(request).response
-    except Exception as exc:
-        code = "Failed to fetch resource"
-        payload = '{0}'.format(exc)
-    else:
-        code = response.code
-        payload = response.payload.decode('utf-8')
-    finally:
-        yield from protocol.shutdown()
-
-    logger.debug('Code: {0} - Payload: {1}'.format(code, payload))
-    return code, payload
+class CoapClient():
+    """
+    Long-lived CoAP client context shared by all requests of a gateway.
+
+    Requests sent to the same node are limited to `max_requests` in flight.
+    The underlying context is recreated after a socket error or after
+    `max_failures` consecutive failed requests.
+    """
+    def __init__(self, max_requests=COAP_NODE_MAX_REQUESTS,
+                 max_failures=COAP_CLIENT_MAX_FAILURES):
+        self.max_requests = max_requests
+        self.max_failures = max_failures
+        self._protocol = None
+        self._lock = asyncio.Lock()
+        self._failures = 0
+        self._semaphores = {}
+
+
+    @asyncio.coroutine
+    def _get_protocol(self):
+        with (yield from self._lock):
+            if self._protocol is None:
+                logger.debug("Creating CoAP client context")
+                self._protocol = yield from aiocoap.Context.create_client_context()
+                self._failures = 0
+        return self._protocol
+
+
+    def _invalidate(self, protocol):
+        """
+        Drop a broken client context, the next request creates a new one.
+        """
+        if self._protocol is not protocol:
+            return
+        logger.warning("Recreating CoAP client context")
+        self._protocol = None
+        asyncio.ensure_future(protocol.shutdown())
+
+
+    def _semaphore(self, address):
+        if address not in self._semaphores:
+            self._semaphores[address] = asyncio.Semaphore(self.max_requests)
+        return self._semaphores[address]
+
+
+    def release(self, address):
+        """
+        Forget the request limiter of a node that has gone.
+        """
+        self._semaphores.pop(address, None)
+
+
+    @asyncio.coroutine
+    def request(self, address, url, method=aiocoap.Code.GET, payload=b'',
+                timeout=COAP_REQUEST_TIMEOUT):
+        """
+        Send a request to the node at `address`, return code and payload.
+        """
+        with (yield from self._semaphore(address)):
+            protocol = yield from self._get_protocol()
+            request = aiocoap.Message(
+                code=method, payload=payload
+            )
+            request.set_request_uri(url)
+            try:
+                response = yield from asyncio.wait_for(
+                    protocol.request(request).response, timeout
+                )
+            except asyncio.TimeoutError:
+                # An unresponsive node says nothing about the context health
+                code = "Failed to fetch resource"
+                payload = 'Timeout after {0}s'.format(timeout)
+            except Exception as exc:
+                code = "Failed to fetch resource"
+                payload = '{0}'.format(exc)
+                self._failures += 1
+                if (isinstance(exc, OSError) or
+                        self._failures >= self.max_failures):
+                    self._invalidate(protocol)
+            else:
+                code = response.code
+                payload = response.payload.decode('utf-8')
+                self._failures = 0
+
+        logger.debug('Code: {0} - Payload: {1}'.format(code, payload))
+        return code, payload
+
+
+    @asyncio.coroutine
+    def shutdown(self):
+        if self._protocol is not None:
+            protocol, self._protocol = self._protocol, None
+            yield from protocol.shutdown()
 
 
 class CoapAliveResource(resource.Resource):
@@ -123,7 +198,10 @@ class CoapGateway(GatewayBase):
     def __init__(self, keys, options):
         self.port = options.coap_port
         self.max_time = options.max_time
+        self.expiry = NodeExpiry(self.max_time)
         self.node_mapping = {}  # map node address to its uuid (TODO: FIXME)
+        self.coap_client = CoapClient()
+        self.discoveries = asyncio.Semaphore(COAP_MAX_DISCOVERIES)
 
         super().__init__(keys, options)
 
@@ -135,7 +213,7 @@ class CoapGateway(GatewayBase):
         root_coap.add_resource(
             ('alive', ), CoapAliveResource(self)
         )
-        asyncio.async(
+        asyncio.ensure_future(
             aiocoap.Context.create_server_context(
                 root_coap, bind=(COAP_GATEWAY_HOST, self.port)
             )
@@ -149,41 +227,58 @@ class CoapGateway(GatewayBase):
         logger.info('CoAP gateway application started')
 
 
-    @gen.coroutine
+    @asyncio.coroutine
     def discover_node(self, node):
         """
         Discover resources available on a node.
+
+        All endpoints of the node are fetched concurrently, the number of
+        nodes being discovered at the same time is bounded gateway-wide.
         """
         address = node.resources['ip']
         coap_node_url = 'coap://[{}]'.format(address)
-        logger.debug("Discovering CoAP node {}".format(address))
 
-        _, payload = yield _coap_resource(
-            '{0}/.well-known/core'.format(coap_node_url),
-            method=aiocoap.Code.GET
-        )
-        endpoints = [
-            endpoint for endpoint in _coap_endpoints(payload)
-            if 'well-known/core' not in endpoint
-        ]
-        logger.debug("Fetching CoAP node resources: {}".format(endpoints))
-
-        for endpoint in endpoints:
-            elems = endpoint.split(';')
-            path = elems.pop(0).replace('<', '').replace('>', '')
-            try:
-                code, payload = yield _coap_resource(
-                    '{0}{1}'.format(coap_node_url, path),
+        with (yield from self.discoveries):
+            logger.debug("Discovering CoAP node {}".format(address))
+            code, payload = yield from self.coap_client.request(
+                address, '{0}/.well-known/core'.format(coap_node_url),
+                method=aiocoap.Code.GET
+            )
+            if not isinstance(code, aiocoap.Code) or not code.is_successful():
+                logger.debug("Cannot discover CoAP node {}: {}".format(address, payload))
+                return
+
+            paths = [
+                endpoint.split(';')[0].replace('<', '').replace('>', '')
+                for endpoint in _coap_endpoints(payload)
+                if 'well-known/core' not in endpoint
+            ]
+            logger.debug("Fetching CoAP node resources: {}".format(paths))
+
+            results = yield from asyncio.gather(*[
+                self.coap_client.request(
+                    address, '{0}{1}'.format(coap_node_url, path),
                     method=aiocoap.Code.GET
+                ) for path in paths
+            ], return_exceptions=True)
+
+        discovered = []
+        for path, result in zip(paths, results):
+            if isinstance(result, Exception):
+                code, payload = None, result
+            else:
+                code, payload = result
+            if not isinstance(code, aiocoap.Code) or not code.is_successful():
+                logger.debug(
+                    "Cannot discover resource {} on node {}: {}".format(path, address, payload)
                 )
-            except:
-                logger.debug("Cannot discover resource {} on node {}".format(endpoint, address))
-                return
+                continue
 
             # Remove '/' from path
             self.forward_data_from_node(node, path[1:], payload)
+            discovered.append(path)
 
-        logger.debug("CoAP node resources '{}' sent to broker".format(endpoints))
+        logger.debug("CoAP node resources '{}' sent to broker".format(discovered))
 
 
     @gen.coroutine
@@ -192,8 +287,8 @@ class CoapGateway(GatewayBase):
         address = node.resources['ip']
         logger.debug("Updating CoAP node '{}' resource '{}'".format(address, endpoint))
 
-        code, p = yield _coap_resource(
-            'coap://[{0}]/{1}'.format(address, endpoint),
+        code, p = yield self.coap_client.request(
+            address, 'coap://[{0}]/{1}'.format(address, endpoint),
             method=aiocoap.Code.PUT,
             payload=payload.encode('ascii')
         )
@@ -223,6 +318,7 @@ class CoapGateway(GatewayBase):
             node = Node(str(uuid.uuid4()), ip=address)
             self.node_mapping.update({address: node.uid})
             self.add_node(node)
+            self.expiry.add(node)
         elif reset:
             # The data of the node need to be reset without removing it. This
             # is particularly the case after a reboot of the node or a
@@ -239,10 +335,17 @@ class CoapGateway(GatewayBase):
         """
         Check and remove nodes that are not alive anymore.
         """
-        to_remove = [ node for node in self.nodes.values()
-            if int(time.time()) > node.last_seen + self.max_time
-        ]
+        to_remove = self.expiry.expired(self.nodes)
         for node in to_remove:
             logger.info("Removing inactive node {}".format(node.uid))
             self.node_mapping.pop(node.resources['ip'])
+            self.coap_client.release(node.resources['ip'])
             self.remove_node(node)
+
+
+    def close_client(self):
+        """
+        Close broker websocket and CoAP client context.
+        """
+        super().close_client()
+        asyncio.ensure_future(self.coap_client.shutdown())
@@ -12,6 +12,7 @@ import tornado.platform.asyncio
 from tornado.options import define, options
 from pycots.common.auth import check_key_file
 from pycots.common.helpers import start_application, parse_command_line
+from pycots.gateway.base import define_gateway_options
 from pycots.gateway.settings import COAP_RETENT_MAX_TIME, COAP_GATEWAY_PORT
 from pycots.gateway.coap.gateway import CoapGateway
 
@@ -22,6 +23,8 @@ def extra_args():
     """
     Parse command line arguments for CoAP gateway application.
     """
+    define_gateway_options()
+
     if not hasattr(options, "coap_port"):
         define(
             "coap_port", default=COAP_GATEWAY_PORT, help="Gateway CoAP server port"
@@ -58,8 +61,14 @@ def run(arguments=[]):
     if not tornado.platform.asyncio.AsyncIOMainLoop().initialize():
         tornado.platform.asyncio.AsyncIOMainLoop().install()
 
+    try:
+        gateway = CoapGateway(keys, options=options)
+    except ValueError as exc:
+        logger.error(exc)
+        return
+
     start_application(
-        CoapGateway(keys, options=options),
+        gateway,
         port=options.coap_port,
         close_client=True
     )
@@ -6,25 +6,60 @@ Updated at: 2018-06
 Content : MQTT gateway module.
 """
 # -*- coding: utf-8 -*-
-import logging
 import time
+import logging
 import uuid
-import json
 import asyncio
 from tornado import gen
 from tornado.ioloop import PeriodicCallback
 from hbmqtt.client import MQTTClient, ClientException
 from hbmqtt.mqtt.constants import QOS_1
-from pycots.gateway.base import Node, GatewayBase
-from pycots.gateway.settings import LOG_LEVEL
+from pycots.common import codec
+from pycots.gateway.base import Node, GatewayBase, NodeExpiry
+from pycots.gateway.mqtt.router import TopicRouter
+from pycots.gateway.settings import (
+    LOG_LEVEL, MQTT_BACKOFF_MIN, MQTT_BACKOFF_MAX, MQTT_REQUEST_TIMEOUT
+)
 
 logger = logging.getLogger("pycots.gw.mqtt")
 logger.setLevel(LOG_LEVEL)
 
+SUBSCRIPTIONS = ('node', 'wildcard')
+STAGES = ('queue', 'decode', 'dispatch')
+
+
+class StageLatency():
+    """
+    Latency of a stage of the MQTT message pipeline.
+    """
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def metrics(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0,
+            'max_ms': self.max * 1000,
+        }
+
 
 class MQTTGateway(GatewayBase):
     """
     Gateway application for MQTT nodes on a network.
+
+    A receiver task puts the messages published by nodes in a bounded
+    queue, handled by `mqtt_workers` coroutines. The receiver waits while
+    the queue is full, and reconnects to the MQTT broker on errors.
     """
     PROTOCOL = "MQTT"
 
@@ -32,13 +67,40 @@ class MQTTGateway(GatewayBase):
         self.host = options.mqtt_host
         self.port = options.mqtt_port
         self.max_time = options.max_time
+        self.expiry = NodeExpiry(self.max_time)
         self.options = options
+        if options.mqtt_subscriptions not in SUBSCRIPTIONS:
+            raise ValueError(
+                "Invalid MQTT subscriptions '{}', choose from {}".format(
+                    options.mqtt_subscriptions, SUBSCRIPTIONS
+                )
+            )
+        # In wildcard mode, the topics of all nodes are received and
+        # filtered here instead of subscribing to each node topic.
+        self.wildcard = options.mqtt_subscriptions == 'wildcard'
         self.node_mapping = {}  # map node id to its uuid (TODO: FIXME)
+        self.node_resources = {}  # map node id to its published resources
+
+        # Most specific filter first: 'node/<id>/resources' is not an update
+        self.router = TopicRouter()
+        self.router.add('node/check', self.handle_node_check)
+        self.router.add('node/+/resources', self.handle_node_resources)
+        self.router.add('node/+/+', self.handle_node_update)
 
         super().__init__(keys, options)
 
+        # Received messages: (topic, payload, reception time)
+        self.mqtt_queue = asyncio.Queue(maxsize=options.mqtt_queue_size)
+        self.mqtt_workers = options.mqtt_workers
+        self.mqtt_connected = False
+        self.closing = False
+        self.reconnections = 0
+        self.invalid = 0
+        self.errors = 0
+        self.stages = {stage: StageLatency() for stage in STAGES}
+
         # Connect to the MQTT broker
-        self.mqtt_client = MQTTClient()
+        self.mqtt_client = self.create_client()
         asyncio.get_event_loop().create_task(self.start())
 
         # Start the node cleanup task
@@ -48,73 +110,182 @@ class MQTTGateway(GatewayBase):
         logger.info('MQTT gateway application started')
 
 
+    @staticmethod
+    def create_client():
+        # Reconnections are handled by the gateway, which subscribes again
+        return MQTTClient(config={'auto_reconnect': False})
+
+
     @asyncio.coroutine
     def start(self):
         """
-        Connect to MQTT broker and subscribe to node check resource.
+        Start the workers, then receive the messages published by nodes.
         """
-        yield from self.mqtt_client.connect(
-            'mqtt://{}:{}'.format(self.host, self.port)
-        )
-        # Subscribe to 'gateway/check' with QOS=1
-        yield from self.mqtt_client.subscribe(
-            [('node/check', QOS_1)]
-        )
-        while True:
+        for _ in range(self.mqtt_workers):
+            asyncio.get_event_loop().create_task(self.process_messages())
+        yield from self.receive_messages()
+
+
+    def subscriptions(self):
+        """
+        Return the topics to subscribe to when connecting to MQTT broker.
+        """
+        topics = [('node/check', QOS_1)]
+        if self.wildcard:
+            # Also matches 'node/<id>/resources'
+            topics.append(('node/+/+', QOS_1))
+        else:
+            # Topics of the nodes known before a reconnection
+            for node_id, resources in self.node_resources.items():
+                topics.append(('node/{}/resources'.format(node_id), QOS_1))
+                topics.extend(
+                    ('node/{}/{}'.format(node_id, resource), QOS_1)
+                    for resource in resources
+                )
+        return topics
+
+
+    @asyncio.coroutine
+    def receive_messages(self):
+        """
+        Connect to MQTT broker and queue the messages received, reconnect
+        with an exponential backoff on errors.
+        """
+        delay = MQTT_BACKOFF_MIN
+        while not self.closing:
             try:
-                logger.debug("Waiting for MQTT messages published by nodes")
-                # Blocked here until a message is received
-                message = yield from self.mqtt_client.deliver_message()
+                yield from self.mqtt_client.connect(
+                    'mqtt://{}:{}'.format(self.host, self.port)
+                )
+                yield from self.mqtt_client.subscribe(self.subscriptions())
+                self.mqtt_connected = True
+                delay = MQTT_BACKOFF_MIN
+                logger.info("Connected to MQTT broker")
+                while True:
+                    # Blocked here until a message is received
+                    message = yield from self.mqtt_client.deliver_message()
+                    packet = message.publish_packet
+                    # Blocked while the workers are late
+                    yield from self.mqtt_queue.put((
+                        packet.variable_header.topic_name,
+                        packet.payload.data,
+                        time.perf_counter()
+                    ))
+            except asyncio.CancelledError:
+                raise
             except ClientException as ce:
                 logger.error("Client exception: {}".format(ce))
-                break
             except Exception as exc:
                 logger.error("General exception: {}".format(exc))
+
+            self.mqtt_connected = False
+            if self.closing:
                 break
-            packet = message.publish_packet
-            topic_name = packet.variable_header.topic_name
+            logger.warning("MQTT broker connection lost, reconnecting in {}s".format(delay))
             try:
-                data = json.loads(
-                    packet.payload.data.decode('utf-8')
-                )
-            except:
+                yield from self.mqtt_client.disconnect()
+            except Exception:
+                pass
+            self.mqtt_client = self.create_client()
+            self.reconnections += 1
+            yield from asyncio.sleep(delay)
+            delay = min(delay * 2, MQTT_BACKOFF_MAX)
+
+
+    @asyncio.coroutine
+    def process_messages(self):
+        """
+        Decode and handle the queued messages, until the gateway closes.
+        """
+        while not self.closing:
+            topic_name, payload, received = yield from self.mqtt_queue.get()
+            start = time.perf_counter()
+            self.stages['queue'].add(start - received)
+            try:
+                data = codec.loads(payload.decode('utf-8'))
+            except (codec.DecodeError, UnicodeDecodeError, AttributeError):
                 # Skip data if not valid
+                self.invalid += 1
                 continue
+            decoded = time.perf_counter()
+            self.stages['decode'].add(decoded - start)
             logger.debug(
                 "Received message from node: {} => {}" .format(topic_name, data)
             )
-            if topic_name.endswith("/check"):
-                asyncio.get_event_loop().create_task(
-                    self.handle_node_check(data)
-                )
-            elif topic_name.endswith("/resources"):
-                asyncio.get_event_loop().create_task(
-                    self.handle_node_resources(topic_name, data)
-                )
-            else:
-                self.handle_node_update(topic_name, data)
+            try:
+                yield from self.dispatch(topic_name, data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("Error while handling MQTT message on {}".format(topic_name))
+            self.stages['dispatch'].add(time.perf_counter() - decoded)
+
+
+    @asyncio.coroutine
+    def dispatch(self, topic_name, data):
+        """
+        Call the handler routing the given topic, wait for the handlers
+        returning a coroutine.
+        """
+        route = self.router.route(topic_name)
+        if route is None:
+            logger.debug("No handler for topic: {}".format(topic_name))
+            return
+        handler, params = route
+        result = handler(*params, data)
+        if asyncio.iscoroutine(result):
+            yield from result
+
+
+    def metrics(self):
+        """
+        Return the gateway metrics, with those of the MQTT message pipeline.
+        """
+        metrics = super().metrics()
+        metrics['mqtt'] = {
+            'connected': self.mqtt_connected,
+            'reconnections': self.reconnections,
+            'queued': self.mqtt_queue.qsize(),
+            'queue_size': self.mqtt_queue.maxsize,
+            'workers': self.mqtt_workers,
+            'invalid': self.invalid,
+            'errors': self.errors,
+            'latency': {
+                stage: latency.metrics() for stage, latency in self.stages.items()
+            },
+        }
+        return metrics
 
 
     def close(self):
+        self.closing = True
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self._disconnect())
 
 
     @asyncio.coroutine
     def _disconnect(self):
-        for node in self.nodes:
-            yield from self._disconnect_from_node(node)
+        if not self.wildcard:
+            for node_id, resources in list(self.node_resources.items()):
+                yield from self._disconnect_from_node(node_id, resources)
         yield from self.mqtt_client.disconnect()
 
 
+    @staticmethod
+    def mqtt_request(coro):
+        # The reply of a lost connection never comes, give up on it
+        return asyncio.wait_for(coro, MQTT_REQUEST_TIMEOUT)
+
+
     @asyncio.coroutine
     def discover_node(self, node):
         discover_topic = 'gateway/{}/discover'.format(node.resources['id'])
-        yield from self.mqtt_client.publish(
+        yield from self.mqtt_request(self.mqtt_client.publish(
             discover_topic,
             b"resources",
             qos=QOS_1
-        )
+        ))
         logger.debug(
             "Published '{}' to topic: {}".format("resources", discover_topic)
         )
@@ -141,51 +312,67 @@ class MQTTGateway(GatewayBase):
         if node_id not in self.node_mapping:
             node = Node(str(uuid.uuid4()), id=node_id)
             self.node_mapping.update({node_id: node.uid})
-
-            resources_topic = 'node/{}/resources'.format(node_id)
-            yield from self.mqtt_client.subscribe(
-                [(resources_topic, QOS_1)]
-            )
-            logger.debug(
-                "Subscribed to topic: {}".format(resources_topic)
-            )
+            self.node_resources[node_id] = set()
+
+            if not self.wildcard:
+                resources_topic = 'node/{}/resources'.format(node_id)
+                try:
+                    yield from self.mqtt_request(self.mqtt_client.subscribe(
+                        [(resources_topic, QOS_1)]
+                    ))
+                except Exception:
+                    # Registered again on the next check of the node
+                    self.node_mapping.pop(node_id, None)
+                    self.node_resources.pop(node_id, None)
+                    raise
+                logger.debug(
+                    "Subscribed to topic: {}".format(resources_topic)
+                )
 
             self.add_node(node)
+            self.expiry.add(node)
         else:
             # The node simply sent a check message to notify that it's still online.
-            node = self.get_node(
-                self.node_mapping[node_id]
-            )
-            node.update_last_seen()
+            node = self.nodes.get(self.node_mapping[node_id])
+            if node is not None:
+                # Not added yet while subscribing to its topics
+                node.update_last_seen()
 
 
     @asyncio.coroutine
-    def handle_node_resources(self, topic, data):
+    def handle_node_resources(self, node_id, data):
         """
         Process resources published by a node.
         """
-        node_id = topic.split("/")[1]
         if node_id not in self.node_mapping:
             return
 
-        yield from self.mqtt_client.subscribe(
-            [('node/{}/{}'.format(node_id, resource), QOS_1) for resource in data]
-        )
-        yield from self.mqtt_client.publish(
+        resources = set(data) - self.node_resources[node_id]
+        if resources and not self.wildcard:
+            yield from self.mqtt_request(self.mqtt_client.subscribe(
+                [('node/{}/{}'.format(node_id, resource), QOS_1) for resource in resources]
+            ))
+        # Only once subscribed, the node may also be gone meanwhile
+        self.node_resources.get(node_id, set()).update(resources)
+        yield from self.mqtt_request(self.mqtt_client.publish(
             'gateway/{}/discover'.format(node_id), b"values", qos=QOS_1
-        )
+        ))
 
 
-    def handle_node_update(self, topic_name, data):
+    def handle_node_update(self, node_id, resource, data):
         """
         Handle mqtt post message sent from coap node.
         """
-        _, node_id, resource = topic_name.split("/")
-        value = data['value']
-        if self.node_mapping[node_id] not in self.nodes:
+        node = self.nodes.get(self.node_mapping.get(node_id))
+        if node is None or resource not in self.node_resources[node_id]:
+            # Node unknown or already removed, or resource not published
+            return
+        try:
+            value = data['value']
+        except (KeyError, TypeError):
+            logger.debug("Invalid update from node {}: {}".format(node_id, data))
             return
 
-        node = self.get_node(self.node_mapping[node_id])
         self.forward_data_from_node(node, resource, value)
 
 
@@ -203,26 +390,23 @@ class MQTTGateway(GatewayBase):
         """
         Check and remove nodes that are not alive anymore.
         """
-        to_remove = [
-            node for node in self.nodes.values()
-            if int(time.time()) > node.last_seen + self.max_time
-        ]
+        to_remove = self.expiry.expired(self.nodes)
         for node in to_remove:
             logger.info("Removing inactive node {}".format(node.uid))
-            asyncio.get_event_loop().create_task(
-                self._disconnect_from_node(node)
-            )
-            self.node_mapping.pop(node.resources['id'])
+            node_id = node.resources['id']
+            resources = self.node_resources.pop(node_id, set())
+            if not self.wildcard:
+                asyncio.get_event_loop().create_task(
+                    self._disconnect_from_node(node_id, resources)
+                )
+            self.node_mapping.pop(node_id)
             self.remove_node(node)
 
 
     @asyncio.coroutine
-    def _disconnect_from_node(self, node):
-        node_id = node.resources['id']
+    def _disconnect_from_node(self, node_id, resources):
+        # All the node topics in a single UNSUBSCRIBE
         yield from self.mqtt_client.unsubscribe(
-            ['node/{}/resource'.format(node_id)]
+            ['node/{}/resources'.format(node_id)] +
+            ['node/{}/{}'.format(node_id, resource) for resource in resources]
         )
-        for resource in node.resources:
-            yield from self.mqtt_client.unsubscribe(
-                ['node/{}/{}'.format(node_id, resource)]
-            )
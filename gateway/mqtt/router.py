@@ -0,0 +1,141 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : MQTT topic router module.
+"""
+# -*- coding: utf-8 -*-
+import logging
+from pycots.gateway.settings import MQTT_ROUTE_CACHE_SIZE
+
+logger = logging.getLogger("pycots.gw.mqtt.router")
+
+SEPARATOR = '/'
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+
+
+class _Level():
+    """
+    Level of the topic filter trie.
+    """
+    __slots__ = ('children', 'handler')
+
+    def __init__(self):
+        self.children = {}
+        self.handler = None
+
+
+def check_filter(topic_filter):
+    """
+    Return the levels of a topic filter, raise ValueError if the MQTT
+    wildcards are misplaced.
+    """
+    levels = topic_filter.split(SEPARATOR)
+    for index, level in enumerate(levels):
+        if level in (SINGLE_LEVEL, MULTI_LEVEL):
+            if level == MULTI_LEVEL and index != len(levels) - 1:
+                raise ValueError(
+                    "Invalid topic filter '{}', '#' must be the last level".format(topic_filter)
+                )
+        elif SINGLE_LEVEL in level or MULTI_LEVEL in level:
+            raise ValueError(
+                "Invalid topic filter '{}', wildcards must fill a level".format(topic_filter)
+            )
+    return levels
+
+
+class TopicRouter():
+    """
+    Dispatch table of MQTT topics, with the MQTT wildcard semantics: '+'
+    matches one level, '#' all the remaining ones.
+
+    Topic filters are compiled into a trie of levels. `route(topic)`
+    returns the handler of the most specific matching filter, an exact
+    level being preferred to '+' and '+' to '#', with the levels matched by
+    wildcards as parameters: 'node/+/+' routes 'node/n1/led' with the
+    parameters ('n1', 'led').
+
+    Nodes publish on a small set of topics, the routes found are cached by
+    topic until `cache_size` topics were seen.
+    """
+    def __init__(self, cache_size=MQTT_ROUTE_CACHE_SIZE):
+        self.root = _Level()
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def add(self, topic_filter, handler):
+        """
+        Route the topics matching the given filter to `handler`.
+        """
+        level = self.root
+        for name in check_filter(topic_filter):
+            level = level.children.setdefault(name, _Level())
+        level.handler = handler
+        self.cache.clear()
+
+    def remove(self, topic_filter):
+        """
+        Stop routing the topics matching the given filter.
+        """
+        path = [self.root]
+        names = check_filter(topic_filter)
+        for name in names:
+            level = path[-1].children.get(name)
+            if level is None:
+                return
+            path.append(level)
+        path[-1].handler = None
+        # Prune the levels left without handler nor children
+        for name, level, parent in zip(reversed(names), reversed(path), reversed(path[:-1])):
+            if level.handler is not None or level.children:
+                break
+            del parent.children[name]
+        self.cache.clear()
+
+    def route(self, topic):
+        """
+        Return the (handler, parameters) route of a topic, None when no
+        filter matches it.
+        """
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+        route = self._match(self.root, topic.split(SEPARATOR), 0, [])
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[topic] = route
+        return route
+
+    def _match(self, level, names, index, params):
+        if index == len(names):
+            if level.handler is not None:
+                return level.handler, tuple(params)
+            # 'a/#' also matches its parent level 'a'
+            child = level.children.get(MULTI_LEVEL)
+            if child is not None and child.handler is not None:
+                return child.handler, tuple(params) + ('',)
+            return None
+
+        name = names[index]
+        child = level.children.get(name)
+        if child is not None:
+            route = self._match(child, names, index + 1, params)
+            if route is not None:
+                return route
+        if index == 0 and name.startswith('$'):
+            # Wildcards do not match the system topics
+            return None
+        child = level.children.get(SINGLE_LEVEL)
+        if child is not None:
+            params.append(name)
+            route = self._match(child, names, index + 1, params)
+            if route is not None:
+                return route
+            params.pop()
+        child = level.children.get(MULTI_LEVEL)
+        if child is not None and child.handler is not None:
+            return child.handler, tuple(params) + (SEPARATOR.join(names[index:]),)
+        return None
@@ -12,7 +12,11 @@ import tornado.platform.asyncio
 from tornado.options import define, options
 from pycots.common.auth import check_key_file
 from pycots.common.helpers import start_application, parse_command_line
-from pycots.gateway.settings import MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_RETENT_MAX_TIME
+from pycots.gateway.base import define_gateway_options
+from pycots.gateway.settings import (
+    MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_RETENT_MAX_TIME, MQTT_SUBSCRIPTIONS,
+    MQTT_WORKERS, MQTT_QUEUE_SIZE
+)
 from pycots.gateway.mqtt.gateway import MQTTGateway
 
 logger = logging.getLogger("pycots.gw.mqtt")
@@ -22,6 +26,8 @@ def extra_args():
     """
     Parse command line arguments for MQTT gateway application.
     """
+    define_gateway_options()
+
     if not hasattr(options, "mqtt_host"):
         define(
             "mqtt_host", default=MQTT_BROKER_HOST, help="Gateway MQTT broker host"
@@ -34,6 +40,21 @@ def extra_args():
         define(
             "max_time", default=MQTT_RETENT_MAX_TIME, help="Maximum retention time (in s) for MQTT dead nodes"
         )
+    if not hasattr(options, "mqtt_subscriptions"):
+        define(
+            "mqtt_subscriptions", default=MQTT_SUBSCRIPTIONS,
+            help="MQTT subscriptions: 'node' for the topics of each node, 'wildcard' for all node topics at once"
+        )
+    if not hasattr(options, "mqtt_workers"):
+        define(
+            "mqtt_workers", default=MQTT_WORKERS,
+            help="Number of coroutines handling the messages received from MQTT nodes"
+        )
+    if not hasattr(options, "mqtt_queue_size"):
+        define(
+            "mqtt_queue_size", default=MQTT_QUEUE_SIZE,
+            help="Maximum number of received MQTT messages waiting to be handled"
+        )
 
 
 def run(arguments=[]):
@@ -61,10 +82,13 @@ def run(arguments=[]):
     if not tornado.platform.asyncio.AsyncIOMainLoop().initialize():
         tornado.platform.asyncio.AsyncIOMainLoop().install()
 
-    start_application(
-        MQTTGateway(keys, options=options),
-        close_client=True
-    )
+    try:
+        gateway = MQTTGateway(keys, options=options)
+    except ValueError as exc:
+        logger.error(exc)
+        return
+
+    start_application(gateway, close_client=True)
 
 if __name__ == '__main__':
     run()
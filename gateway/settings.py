@@ -4,6 +4,10 @@ import logging
 COAP_GATEWAY_HOST = 'localhost'
 COAP_GATEWAY_PORT = 5688
 COAP_RETENT_MAX_TIME = 120
+COAP_NODE_MAX_REQUESTS = 4
+COAP_CLIENT_MAX_FAILURES = 10
+COAP_REQUEST_TIMEOUT = 5
+COAP_MAX_DISCOVERIES = 64
 
 #WebSocket
 WS_GATEWAY_HOST  = 'localhost'
@@ -13,6 +17,28 @@ WS_GATEWAY_PORT = 8004
 MQTT_BROKER_HOST = 'localhost'
 MQTT_BROKER_PORT = 1886
 MQTT_RETENT_MAX_TIME = 120
+MQTT_ROUTE_CACHE_SIZE = 10000  # topics whose route is cached
+MQTT_SUBSCRIPTIONS = 'node'  # 'node' (per node topics) or 'wildcard'
+MQTT_WORKERS = 4  # coroutines decoding and handling node messages
+MQTT_QUEUE_SIZE = 1000  # received messages waiting for a worker
+MQTT_BACKOFF_MIN = 1  # s
+MQTT_BACKOFF_MAX = 60  # s
+MQTT_REQUEST_TIMEOUT = 10  # s, for subscribe and publish round trips
+
+#Broker link
+GATEWAY_BATCH_WINDOW = 0  # ms, 0 disables batching
+GATEWAY_BATCH_SIZE = 100
+GATEWAY_BROKER_FORMAT = 'json'
+GATEWAY_BACKOFF_MIN = 1  # s
+GATEWAY_BACKOFF_MAX = 60  # s
+GATEWAY_CONNECT_TIMEOUT = 10  # s
+GATEWAY_PING_INTERVAL = 10  # s
+GATEWAY_PING_TIMEOUT = 30  # s
+GATEWAY_QUEUE_SIZE = 10000  # messages waiting for the broker
+GATEWAY_QUEUE_POLICY = 'coalesce'  # 'drop-oldest' or 'coalesce'
+GATEWAY_RATE_LIMITS = ''  # max updates per endpoint, e.g. 'imu:10,temp:1' (in Hz)
+GATEWAY_SNAPSHOT_CHUNK = 500  # nodes per snapshot message
+GATEWAY_MAX_TOMBSTONES = 10000  # removed nodes remembered for delta sync
 
 #LOG_SETTING
 LOG_LEVEL = logging.DEBUG
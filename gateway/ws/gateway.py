@@ -8,8 +8,8 @@ Content : Websocket nodes gateway module.
 # -*- coding: utf-8 -*-
 import logging
 import uuid
-import json
 from tornado import gen, websocket
+from pycots.common import codec
 from pycots.common.messaging import Message
 from pycots.gateway.base import GatewayBase, Node
 from pycots.gateway.settings import LOG_LEVEL
@@ -34,8 +34,7 @@ class WebsocketNodeHandler(websocket.WebSocketHandler):
         self.set_nodelay(True)
         logger.debug("New node websocket opened")
         node = Node(str(uuid.uuid4()))
-        self.application.node_mapping.update({self: node.uid})
-        self.application.add_node(node)
+        self.application.add_node(node, ws=self)
 
 
     @gen.coroutine
@@ -75,29 +74,48 @@ class WebsocketGateway(GatewayBase):
 
         GatewayBase.__init__(self, keys, options, handlers=handlers)
 
-        self.node_mapping = {}
+        self.node_mapping = {}     # map node websocket to its uid
+        self.node_websockets = {}  # map node uid to its websocket
 
         logger.info(
             'WS gateway started, listening on port {}'.format(options.gateway_port)
         )
 
 
+    def add_node(self, node, ws=None):
+        """
+        Add a new node, and the websocket it is connected with.
+        """
+        if ws is not None:
+            self.node_mapping.update({ws: node.uid})
+            self.node_websockets.update({node.uid: ws})
+        return super().add_node(node)
+
+
+    def remove_node(self, node):
+        """
+        Remove a node and forget its websocket.
+        """
+        ws = self.node_websockets.pop(node.uid, None)
+        if ws is not None:
+            self.node_mapping.pop(ws, None)
+        super().remove_node(node)
+
+
     @gen.coroutine
     def discover_node(self, node):
-        for ws, uid in self.node_mapping.items():
-            if node.uid == uid:
-                yield ws.write_message(Message.discover_node())
-                break
+        ws = self.node_websockets.get(node.uid)
+        if ws is not None:
+            yield ws.write_message(Message.discover_node())
 
 
     @gen.coroutine
     def update_node_resource(self, node, resource, value):
-        for ws, uid in self.node_mapping.items():
-            if node.uid == uid:
-                ws.write_message(
-                    json.dumps({"endpoint": resource, "payload": value})
-                )
-                break
+        ws = self.node_websockets.get(node.uid)
+        if ws is not None:
+            ws.write_message(
+                codec.dumps({"endpoint": resource, "payload": value})
+            )
 
 
     def on_node_message(self, ws, message):
@@ -106,8 +124,8 @@ class WebsocketGateway(GatewayBase):
         """
         if message['type'] == "update":
             logger.debug("New update message received from node websocket")
+            node = self.get_node(self.node_mapping[ws])
             for key, value in message['data'].items():
-                node = self.get_node(self.node_mapping[ws])
                 self.forward_data_from_node(node, key, value)
         else:
             logger.debug("Invalid message received from node websocket")
@@ -119,4 +137,3 @@ class WebsocketGateway(GatewayBase):
         """
         if ws in self.node_mapping:
             self.remove_node(self.get_node(self.node_mapping[ws]))
-            self.node_mapping.pop(ws)
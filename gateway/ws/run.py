@@ -11,6 +11,7 @@ import logging
 from tornado.options import define, options
 from pycots.common.auth import check_key_file
 from pycots.common.helpers import start_application, parse_command_line
+from pycots.gateway.base import define_gateway_options
 from pycots.gateway.settings import WS_GATEWAY_PORT
 from pycots.gateway.ws.gateway import WebsocketGateway
 
@@ -21,6 +22,8 @@ def extra_args():
     """
     Parse command line arguments for websocket gateway application.
     """
+    define_gateway_options()
+
     if not hasattr(options, "gateway_port"):
         define("gateway_port", default=WS_GATEWAY_PORT, help="Node gateway websocket port")
 
@@ -47,8 +50,14 @@ def run(arguments=[]):
         logger.error(exc)
         return
 
+    try:
+        gateway = WebsocketGateway(keys, options=options)
+    except ValueError as exc:
+        logger.error(exc)
+        return
+
     start_application(
-        WebsocketGateway(keys, options=options),
+        gateway,
         port=options.gateway_port,
         close_client=True
     )
@@ -5,16 +5,31 @@ Broker tornado application module.
 """
 import uuid
 import logging
+from functools import partial
 from tornado import gen, web, websocket
-from pycots.common.auth import verify_auth_token
+from tornado.ioloop import IOLoop
+from pycots.common import codec
+from pycots.common.auth import verify_auth_token, session_token
 from pycots.common.messaging import Message
+from pycots.common.outbox import Outbox, COALESCE, DROP_OLDEST
+from pycots.service.broker.bus import BrokerBus
+from pycots.service.broker.cache import NodeStateCache
+from pycots.service.broker.cluster import BrokerCluster
+from pycots.service.broker.fanout import PreparedMessage
+from pycots.service.broker.subscriptions import SubscriptionIndex, WILDCARD
+from pycots.service.settings import BROKER_AUTH_TIMEOUT, BROKER_GATEWAY_GRACE
 
 logger = logging.getLogger("pycots.broker")
 
+CLIENT_OVERFLOW = ('coalesce', 'disconnect')
+
 
 class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
 
     authentified = False
+    auth_timeout = None
+    format = codec.JSON
+    session = None
 
     def check_origin(self, origin):
         """
@@ -22,36 +37,95 @@ class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
         """
         return True
 
-    @gen.coroutine
+    def select_subprotocol(self, subprotocols):
+        """
+        Select the wire format proposed by the gateway, JSON otherwise.
+        """
+        for subprotocol in subprotocols:
+            if subprotocol in codec.SUBPROTOCOLS:
+                self.format = codec.SUBPROTOCOLS[subprotocol]
+                return subprotocol
+        return None
+
     def open(self):
         """
         Discover nodes on each opened connection.
         """
         self.set_nodelay(True)
-        logger.info("New gateway websocket opened")
+        logger.info(
+            "New gateway websocket opened ({} format)".format(self.format.name)
+        )
+
+        # The gateway has to authenticate before the deadline.
+        self.auth_timeout = IOLoop.current().call_later(
+            BROKER_AUTH_TIMEOUT, self.on_auth_timeout
+        )
 
-        # Wait 2 seconds to get the gateway authentication token.
-        yield gen.sleep(2)
+    def on_auth_timeout(self):
+        """
+        Close the websocket if the gateway did not authenticate in time.
+        """
+        self.auth_timeout = None
         if not self.authentified:
+            logger.info("Gateway websocket authentication timed out, closing.")
             self.close()
 
+    def cancel_auth_timeout(self):
+        if self.auth_timeout is not None:
+            IOLoop.current().remove_timeout(self.auth_timeout)
+            self.auth_timeout = None
+
     @gen.coroutine
     def on_message(self, raw):
         """
         Triggered when a message is received from the broker child.
         """
         if not self.authentified:
-            if verify_auth_token(raw, self.application.keys):
+            # Gateways send an auth message with their id, or only a token
+            token, gateway_id, floor = raw, None, None
+            try:
+                request = self.format.decode(raw)
+            except (codec.DecodeError, TypeError):
+                request = None
+            if isinstance(request, dict) and request.get('type') == "auth":
+                token = request.get('token')
+                gateway_id = request.get('gateway')
+                floor = request.get('seq')
+            valid = (
+                isinstance(token, (str, bytes)) and
+                (gateway_id is None or isinstance(gateway_id, str)) and
+                (floor is None or (isinstance(floor, int) and not isinstance(floor, bool)))
+            )
+
+            if valid and token and verify_auth_token(token, self.application.keys):
                 logger.info("Gateway websocket authentication verified")
+                self.cancel_auth_timeout()
                 self.authentified = True
-                self.application.gateways.update({self: []})
+                mark = self.application.add_gateway(self, gateway_id, floor)
+                # Acknowledge so the gateway can start streaming right away,
+                # reconnections can use the cheaper session token. The last
+                # sequence number received lets the gateway only send what
+                # was missed.
+                self.write_message(
+                    Message.auth(
+                        'ok', session_token(self.application.keys), self.format,
+                        seq=mark
+                    ),
+                    binary=self.format.binary
+                )
             else:
                 logger.info("Gateway websocket authentication failed, closing.")
+                self.write_message(
+                    Message.auth('failed', fmt=self.format),
+                    binary=self.format.binary
+                )
                 self.close()
         else:
-            message, reason = Message.check_message(raw)
+            message, reason = Message.check_message(raw, self.format)
             if message is not None:
-                self.application.on_gateway_message(self, message)
+                self.application.on_gateway_message(
+                    self, message, None if self.format.binary else raw
+                )
             else:
                 logger.debug("Invalid message, closing websocket")
                 self.close(code=1003, reason="{}.".format(reason))
@@ -61,6 +135,7 @@ class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
         Remove websocket from internal list.
         """
         logger.info("Gateway websocket closed")
+        self.cancel_auth_timeout()
         self.application.remove_ws(self)
 
 
@@ -103,14 +178,121 @@ class BrokerWebsocketClientHandler(websocket.WebSocketHandler):
         self.application.remove_ws(self.uid)
 
 
+class BrokerWebsocketPeerHandler(websocket.WebSocketHandler):
+
+    authentified = False
+    auth_timeout = None
+    cluster = None
+
+    def open(self):
+        """
+        Wait for the peer broker to authenticate.
+        """
+        if isinstance(self.application.bus, BrokerCluster):
+            self.cluster = self.application.bus
+        else:
+            logger.info("Peer broker connection refused, clustering disabled")
+            self.close(code=1008, reason="Clustering disabled.")
+            return
+        self.set_nodelay(True)
+        logger.info("New peer broker websocket opened")
+        self.auth_timeout = IOLoop.current().call_later(
+            BROKER_AUTH_TIMEOUT, self.on_auth_timeout
+        )
+
+    def on_auth_timeout(self):
+        """
+        Close the websocket if the peer did not authenticate in time.
+        """
+        self.auth_timeout = None
+        if not self.authentified:
+            logger.info("Peer broker authentication timed out, closing.")
+            self.close()
+
+    def on_message(self, raw):
+        """
+        Triggered when a message is received from a peer broker.
+        """
+        if self.cluster is None:
+            return
+        if self.authentified:
+            self.cluster.on_link_message(self, raw)
+            return
+
+        if self.auth_timeout is not None:
+            IOLoop.current().remove_timeout(self.auth_timeout)
+            self.auth_timeout = None
+        if verify_auth_token(raw, self.application.keys):
+            logger.info("Peer broker authentication verified")
+            self.authentified = True
+            self.cluster.accept_link(self, raw)
+        else:
+            logger.info("Peer broker authentication failed, closing.")
+            self.close()
+
+    def on_close(self):
+        """
+        Forget the peer link.
+        """
+        logger.info("Peer broker websocket closed")
+        if self.auth_timeout is not None:
+            IOLoop.current().remove_timeout(self.auth_timeout)
+            self.auth_timeout = None
+        if self.authentified:
+            self.cluster.remove_link(self)
+
+
+class BrokerMetricsHandler(web.RequestHandler):
+    """
+    Report the connections and client queues of the broker.
+    """
+    def get(self):
+        self.write(self.application.metrics())
+
+
 class Broker(web.Application):
     """
     Pyaiot broker.
     """
-    def __init__(self, keys, options):
+    def __init__(self, keys, options, worker=None):
         self.keys = keys
         self.gateways = {}
         self.clients = {}
+        self.subscriptions = SubscriptionIndex()
+        self.states = NodeStateCache()
+        # Gateways identified by an id, kept a while after disconnection
+        self.gateway_sessions = {}
+        self.outboxes = {}
+        self.evicted = 0
+        if options.client_overflow not in CLIENT_OVERFLOW:
+            raise ValueError(
+                "Invalid client overflow '{}', choose from {}".format(
+                    options.client_overflow, CLIENT_OVERFLOW
+                )
+            )
+        self.client_queue_size = options.client_queue_size
+        self.client_overflow = options.client_overflow
+
+        # Nodes behind gateways connected to the other worker processes,
+        # or to the other brokers of the cluster
+        self.remote_nodes = {}  # worker or broker id -> set of node uids
+        self.worker = worker
+        self.bus = None
+        if worker is not None:
+            self.bus = BrokerBus(
+                options.bus_path.format(options.broker_port), worker,
+                self.on_bus_event, self.bus_announce, self.on_bus_disconnect
+            )
+        elif options.peers or options.broker_id:
+            # A broker without peers to dial joins the cluster by setting
+            # its id, and is dialed by the others.
+            self.bus = BrokerCluster(
+                options.broker_id or uuid.uuid4().hex, keys,
+                [url.strip() for url in options.peers.split(',') if url.strip()],
+                self.on_bus_event, self.bus_announce
+            )
+        if self.bus is not None:
+            IOLoop.current().add_callback(self.bus.start_bus)
 
         if options.debug:
             logger.setLevel(logging.DEBUG)
@@ -118,8 +300,13 @@ class Broker(web.Application):
         handlers = [
             (r"/ws", BrokerWebsocketClientHandler),
             (r"/gw", BrokerWebsocketGatewayHandler),
+            (r"/peer", BrokerWebsocketPeerHandler),
+            (r"/metrics", BrokerMetricsHandler),
         ]
         settings = {'debug': True}
+        if worker is not None:
+            # Reloading is not supported by forked worker processes
+            settings['autoreload'] = False
 
         super().__init__(handlers, **settings)
         
@@ -127,28 +314,190 @@ class Broker(web.Application):
             'Application started, listening on port {}'.format(options.broker_port)
         )
 
-    def broadcast(self, message):
+    def metrics(self):
         """
-        Broadcast message to all clients.
+        Return the number of connections and the state of client queues.
+        """
+        outboxes = self.outboxes.values()
+        depths = [len(outbox) for outbox in outboxes]
+        return {
+            'gateways': len(self.gateways),
+            'clients': len(self.clients),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'backlogged_clients': sum(1 for depth in depths if depth),
+            'dropped': sum(outbox.dropped for outbox in outboxes),
+            'coalesced': sum(outbox.coalesced for outbox in outboxes),
+            'evicted': self.evicted,
+            'cached_nodes': len(self.states),
+            'gateway_sessions': len(self.gateway_sessions),
+            'worker': self.worker,
+            'peers': sorted(self.bus.peers) if isinstance(self.bus, BrokerCluster) else [],
+            'remote_nodes': sum(len(uids) for uids in self.remote_nodes.values()),
+        }
+
+    def broadcast(self, message, uid=None, endpoint=None, key=None):
+        """
+        Broadcast message to all clients interested by the given node uid
+        and endpoint, to all clients when no uid is given.
+
+        Queued messages with the same `key` are replaced for clients
+        lagging behind.
         """
         logger.debug(
             "Broadcasting message '{}' to web clients.".format(message)
         )
-        for uid in self.clients.keys():
-            self.send_to_client(uid, message)
+        message = PreparedMessage(message)
+        # Clients may be evicted while sending
+        if uid is None:
+            recipients = list(self.clients)
+        else:
+            recipients = self.subscriptions.recipients(uid, endpoint)
+        for client in recipients:
+            if client in self.clients:
+                self.send_to_client(client, message, key)
+
+    def broadcast_batch(self, updates):
+        """
+        Broadcast a list of node updates, each client only receives the
+        updates it is interested in.
+        """
+        if self.subscriptions.unfiltered:
+            message = PreparedMessage(Message.batch(updates))
+            for client in list(self.subscriptions.unfiltered):
+                if client in self.clients:
+                    self.send_batch_to_client(client, updates, message)
+        selected = {}
+        for update in updates:
+            for client in self.subscriptions.subscribers(update['uid'], update['endpoint']):
+                selected.setdefault(client, []).append(update)
+        for client, client_updates in selected.items():
+            if client in self.clients:
+                self.send_batch_to_client(client, client_updates)
+
+    def broadcast_snapshot(self, nodes):
+        """
+        Broadcast the state of several nodes, each client only receives the
+        nodes and resources it is interested in.
+        """
+        if self.subscriptions.unfiltered:
+            message = PreparedMessage(Message.snapshot(nodes))
+            for client in list(self.subscriptions.unfiltered):
+                if client in self.clients:
+                    self.send_to_client(client, message)
+        selected = {}
+        for uid, resources in nodes.items():
+            for client in self.subscriptions.subscribers(uid):
+                selected.setdefault(client, {})[uid] = {
+                    endpoint: data for endpoint, data in resources.items()
+                    if self.subscriptions.wants(client, uid, endpoint)
+                }
+        for client, client_nodes in selected.items():
+            if client in self.clients:
+                self.send_to_client(client, Message.snapshot(client_nodes))
 
-    def send_to_client(self, uid, message):
+    def broadcast_gateway_out(self, uids):
         """
-        Send message to single client given its uid.
+        Forget the given nodes and notify clients, in a single message, that
+        they are out.
         """
+        for uid in uids:
+            self.states.remove(uid)
+        if self.subscriptions.unfiltered:
+            message = PreparedMessage(Message.gateway_out(list(uids)))
+            for client in list(self.subscriptions.unfiltered):
+                if client in self.clients:
+                    self.send_to_client(client, message)
+        selected = {}
+        for uid in uids:
+            for client in self.subscriptions.subscribers(uid):
+                selected.setdefault(client, []).append(uid)
+        for client, client_uids in selected.items():
+            if client in self.clients:
+                self.send_to_client(client, Message.gateway_out(client_uids))
+
+    def send_to_client(self, uid, message, key=None):
+        """
+        Queue message for single client given its uid.
+
+        With the 'coalesce' overflow, a queued message with the same key is
+        replaced. With 'disconnect', a client whose queue is full is closed.
+        """
+        outbox = self.outboxes.get(uid)
+        if outbox is None:
+            return
+        if (self.client_overflow == 'disconnect' and
+                len(outbox) >= self.client_queue_size):
+            self.evict_client(uid)
+            return
         logger.debug(
             "Sending message '{}' to client {}.".format(message, uid)
         )
-        self.clients[uid].write_message(message)
+        outbox.put(message, key=key)
+
+    def send_batch_to_client(self, uid, updates, message=None, dst='all'):
+        """
+        Send a batch of node updates to single client.
+
+        A client lagging behind gets the updates queued one by one, so that
+        they are coalesced with the queued ones.
+        """
+        outbox = self.outboxes.get(uid)
+        if outbox is None:
+            return
+        if len(outbox) and self.client_overflow == 'coalesce':
+            for update in updates:
+                self.send_to_client(
+                    uid,
+                    Message.update_node(
+                        update['uid'], update['endpoint'], update['data'],
+                        dst=dst
+                    ),
+                    (update['uid'], update['endpoint'])
+                )
+        else:
+            self.send_to_client(
+                uid, message or Message.batch(updates, dst=dst)
+            )
+
+    def write_to_client(self, ws, message):
+        """
+        Write message to a client websocket, return a Future resolved once
+        written.
+        """
+        if isinstance(message, PreparedMessage):
+            return message.write_to(ws)
+        return ws.write_message(message)
+
+    def evict_client(self, uid):
+        """
+        Close the connection of a client not reading its messages.
+        """
+        logger.warning(
+            "Client {} too slow, {} messages queued: disconnecting".format(
+                uid, len(self.outboxes[uid])
+            )
+        )
+        self.evicted += 1
+        ws = self.clients[uid]
+        self.remove_ws(uid)
+        ws.close(code=1008, reason="Too slow.")
+
+    def reply_to_client(self, uid, message, node_uid, endpoint=None):
+        """
+        Send message to single client if it is interested by the given node.
+        """
+        if (uid in self.clients and
+                self.subscriptions.wants(uid, node_uid, endpoint)):
+            self.send_to_client(uid, message, (node_uid, endpoint))
 
     def on_client_message(self, ws, message):
         """
         Handle a message received from a client.
+
+        A 'new' message is answered from the node state cache, in a single
+        snapshot message when its 'snapshot' key is true, node by node
+        otherwise.
         """
         logger.debug(
             "Handling message '{}' received from client websocket.".format(message)
@@ -157,58 +506,314 @@ class Broker(web.Application):
             logger.info("New client connected: {}".format(ws.uid))
             if ws.uid not in self.clients.keys():
                 self.clients.update({ws.uid: ws})
+                self.subscriptions.add_client(ws.uid)
+                outbox = Outbox(
+                    partial(self.write_to_client, ws),
+                    maxsize=self.client_queue_size,
+                    policy=COALESCE if self.client_overflow == 'coalesce' else DROP_OLDEST
+                )
+                outbox.start()
+                self.outboxes.update({ws.uid: outbox})
+            # The node states are served from the cache, gateways are not
+            # asked to replay theirs.
+            if message.get('snapshot'):
+                self.send_snapshot(ws.uid)
+            else:
+                self.send_replay(ws.uid)
+            return
         elif message['type'] == "update":
             logger.debug("New message from client: {}".format(ws.uid))
+        elif message['type'] in ("subscribe", "unsubscribe"):
+            if ws.uid not in self.clients:
+                # Subscriptions are only cleaned up for registered clients
+                logger.debug(
+                    "Ignoring subscription of unregistered client {}".format(ws.uid)
+                )
+                return
+            self.on_client_subscription(ws, message)
+            return
+        else:
+            # Other types are sent by the broker and gateways only
+            logger.debug(
+                "Dropping '{}' message from client {}".format(message['type'], ws.uid)
+            )
+            return
 
         # Simply forward this message to satellite gateways
+        self.forward_to_gateways(message)
+        if self.bus is not None:
+            self.bus.publish('client', message)
+
+    def send_snapshot(self, uid):
+        """
+        Send the cached state of the nodes a client is interested in, in a
+        single message.
+        """
+        if uid in self.subscriptions.unfiltered:
+            nodes = self.states.snapshot()
+        else:
+            nodes = self.states.snapshot(partial(self.subscriptions.wants, uid))
+        self.send_to_client(uid, Message.snapshot(nodes, dst=uid))
+
+    def send_replay(self, uid):
+        """
+        Send the cached state of the nodes a client is interested in, as a
+        'new' message per node followed by an 'update' message per
+        resource, for clients not asking for a snapshot.
+        """
+        for node_uid, resources in list(self.states.nodes.items()):
+            self.reply_to_client(uid, Message.new_node(node_uid, dst=uid), node_uid)
+            for endpoint, data in resources.items():
+                self.reply_to_client(
+                    uid, Message.update_node(node_uid, endpoint, data, dst=uid),
+                    node_uid, endpoint
+                )
+
+    def forward_to_gateways(self, message):
+        """
+        Send a client message to the gateways connected to this process.
+        """
         logger.debug("Forwarding message {} to gateways".format(message))
+        encoded = {}
         for gw in self.gateways:
-            gw.write_message(Message.serialize(message))
+            if gw.format not in encoded:
+                encoded[gw.format] = Message.serialize(message, gw.format)
+            gw.write_message(encoded[gw.format], binary=gw.format.binary)
+
+    def on_client_subscription(self, ws, message):
+        """
+        Handle a subscription change of a client.
+
+        'data' is a dict, or a list of dicts, with optional 'uid' and
+        'endpoint' keys, missing keys meaning '*'.
+        """
+        data = message.get('data') or {}
+        if isinstance(data, dict):
+            data = [data]
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            uid = item.get('uid', WILDCARD)
+            endpoint = item.get('endpoint', WILDCARD)
+            if message['type'] == "subscribe":
+                logger.debug("Client {} subscribed to {}/{}".format(ws.uid, uid, endpoint))
+                self.subscriptions.subscribe(ws.uid, uid, endpoint)
+            else:
+                logger.debug("Client {} unsubscribed from {}/{}".format(ws.uid, uid, endpoint))
+                self.subscriptions.unsubscribe(ws.uid, uid, endpoint)
 
     @gen.coroutine
-    def on_gateway_message(self, ws, message):
+    def on_gateway_message(self, ws, message, raw=None):
         """
         Handle a message received from a gateway.
 
-        This method redirect messages from gateways to the right destinations:
-        - for freshly new information initiated by nodes => broadcast
-        - for replies to new client connection => only send to this client
+        Messages about nodes not known to come from this gateway are
+        ignored, the others are delivered to clients and published to the
+        other broker workers.
+
+        When given, `raw` is the message as received and is forwarded as is
+        instead of serializing the message again.
         """
         logger.debug(
             "Handling message '{}' received from gateway.".format(message)
         )
+        if ws not in self.gateways:
+            # Former link of a gateway connected again
+            return
+        session = ws.session
+        if session is not None:
+            # Messages are received in sequence order
+            if message['type'] == "batch":
+                seq = max(
+                    (update.get('seq') or 0 for update in message['updates']),
+                    default=0
+                )
+            else:
+                seq = message.get('seq') or 0
+            if seq > (session['seq'] or 0):
+                session['seq'] = seq
+
+        nodes = self.gateways[ws]
         if message['type'] == "new":
             # Received when notifying clients of a new node available
-            if not message['uid'] in self.gateways[ws]:
-                self.gateways[ws].append(message['uid'])
+            nodes.add(message['uid'])
+        elif message['type'] == "out":
+            if message['uid'] not in nodes:
+                return
+            nodes.discard(message['uid'])
+        elif message['type'] == "update":
+            if message['uid'] not in nodes:
+                return
+        elif message['type'] == "batch":
+            # Group of updates pushed by nodes behind this gateway, only
+            # updates of nodes known to come from this gateway are kept.
+            updates = [
+                update for update in message['updates']
+                if update['uid'] in nodes
+            ]
+            if not updates:
+                return
+            message['updates'] = updates
+        elif message['type'] == "snapshot":
+            # State of nodes behind this gateway, sent in chunks
+            if not isinstance(message.get('nodes'), dict):
+                return
+            nodes.update(message['nodes'])
+        elif message['type'] != "reset":
+            return
 
+        self.deliver(message, raw)
+        if self.bus is not None:
+            self.bus.publish('gateway', message)
+
+    def deliver(self, message, raw=None):
+        """
+        Deliver a gateway message to the clients of this process.
+
+        This method redirect messages from gateways to the right destinations:
+        - for freshly new information initiated by nodes => broadcast
+        - for replies to new client connection => only send to this client
+
+        The node state cache is kept up to date on the way.
+        """
+        if message['type'] == "new":
+            self.states.add(message['uid'])
+        elif message['type'] == "update":
+            self.states.update(message['uid'], message['endpoint'], message['data'])
+        elif message['type'] == "batch":
+            for update in message['updates']:
+                self.states.update(update['uid'], update['endpoint'], update['data'])
+        elif message['type'] == "reset":
+            self.states.reset(message['uid'])
+        elif message['type'] == "out":
+            self.states.remove(message['uid'])
+        elif message['type'] == "snapshot":
+            for uid, resources in message['nodes'].items():
+                self.states.set(uid, resources)
+
+        if message['type'] == "snapshot":
             if message['dst'] == "all":
-                # Occurs when an unknown new node arrived
-                self.broadcast(Message.serialize(message))
+                self.broadcast_snapshot(message['nodes'])
+            elif message['dst'] in self.clients.keys():
+                dst = message['dst']
+                nodes = message['nodes']
+                if dst not in self.subscriptions.unfiltered:
+                    wants = partial(self.subscriptions.wants, dst)
+                    nodes = {
+                        uid: {
+                            endpoint: data for endpoint, data in resources.items()
+                            if wants(uid, endpoint)
+                        }
+                        for uid, resources in nodes.items() if wants(uid)
+                    }
+                if nodes:
+                    self.send_to_client(dst, Message.snapshot(nodes, dst=dst))
+            return
+
+        if message['type'] == "batch":
+            updates = message['updates']
+            if message['dst'] == "all":
+                self.broadcast_batch(updates)
             elif message['dst'] in self.clients.keys():
+                dst = message['dst']
+                updates = [
+                    update for update in updates
+                    if self.subscriptions.wants(dst, update['uid'], update['endpoint'])
+                ]
+                if updates:
+                    self.send_batch_to_client(dst, updates, dst=dst)
+            return
+
+        if raw is None:
+            raw = Message.serialize(message)
+        if message['type'] == "new":
+            if message['dst'] == "all":
+                # Occurs when an unknown new node arrived
+                self.broadcast(raw, message['uid'], key=(message['uid'], None))
+            else:
                 # Occurs when a single client has just connected
-                self.send_to_client(
-                    message['dst'], Message.serialize(message)
+                self.reply_to_client(
+                    message['dst'], raw, message['uid']
                 )
-        elif (message['type'] == "out" and message['uid'] in self.gateways[ws]):
+        elif message['type'] == "out":
             # Node disparition are always broadcasted to clients
-            self.gateways[ws].remove(message['uid'])
-            self.broadcast(Message.serialize(message))
+            self.broadcast(raw, message['uid'], key=(message['uid'], None))
         elif message['type'] == "reset":
             # Occurs when a node has reset (reboot, firmware update):
             # require broadcast
-            self.broadcast(Message.serialize(message))
-        elif (message['type'] in "update" and message['uid'] in self.gateways[ws]):
+            self.broadcast(raw, message['uid'])
+        elif message['type'] == "update":
             if message['dst'] == "all":
                 # Occurs when a new update was pushed by a node:
                 # require broadcast
-                self.broadcast(Message.serialize(message))
-            elif message['dst'] in self.clients.keys():
+                self.broadcast(
+                    raw, message['uid'], message['endpoint'],
+                    key=(message['uid'], message['endpoint'])
+                )
+            else:
                 # Occurs when a new client has just connected:
                 # Only the cached information of a node are pushed to this
                 # specific client
-                self.send_to_client(
-                    message['dst'], Message.serialize(message))
+                self.reply_to_client(
+                    message['dst'], raw,
+                    message['uid'], message['endpoint']
+                )
+
+    def on_bus_event(self, event):
+        """
+        Handle an event published by another broker worker or peer broker.
+        """
+        origin, message = event['origin'], event['message']
+        if event['kind'] == "gateway":
+            nodes = self.remote_nodes.setdefault(origin, set())
+            if message['type'] == "new":
+                nodes.add(message['uid'])
+            elif message['type'] == "out":
+                nodes.discard(message['uid'])
+            elif message['type'] == "snapshot":
+                nodes.update(message['nodes'])
+            self.deliver(message)
+        elif event['kind'] == "client":
+            self.forward_to_gateways(message)
+        elif event['kind'] == "claim":
+            self.release_gateway(message['gateway'])
+        elif event['kind'] == "release":
+            # Nodes now behind another worker or broker, not out
+            self.remote_nodes.get(origin, set()).difference_update(message['uids'])
+        elif event['kind'] == "leave":
+            if message is None:
+                # The worker itself is gone
+                uids = self.remote_nodes.pop(origin, set())
+            else:
+                nodes = self.remote_nodes.get(origin, set())
+                uids = nodes.intersection(message['uids'])
+                nodes.difference_update(uids)
+            if uids:
+                self.broadcast_gateway_out(uids)
+
+    def bus_announce(self):
+        """
+        Return the events announcing the nodes of this process on a new bus
+        or peer link.
+        """
+        return [
+            ('gateway', {
+                'type': "snapshot",
+                'nodes': {uid: self.states.nodes.get(uid, {}) for uid in nodes},
+                'dst': "all"
+            })
+            for nodes in self.gateways.values() if nodes
+        ]
+
+    def on_bus_disconnect(self):
+        """
+        Forget the nodes of the other workers when the bus link is lost,
+        they are announced again on reconnection.
+        """
+        uids = set().union(*self.remote_nodes.values())
+        self.remote_nodes.clear()
+        if uids:
+            self.broadcast_gateway_out(uids)
 
     def remove_ws(self, ws):
         """
@@ -216,8 +821,130 @@ class Broker(web.Application):
         """
         if ws in self.clients:
             self.clients.pop(ws)
+            self.subscriptions.remove_client(ws)
+            self.outboxes.pop(ws).clear()
         elif ws in self.gateways.keys():
-            # Notify clients that the nodes behind the closed gateway are out.
-            for node_uid in self.gateways[ws]:
-                self.broadcast(Message.out_node(node_uid))
-            self.gateways.pop(ws)
+            uids = self.gateways.pop(ws)
+            if ws.session is not None:
+                # The nodes are kept for a while, the gateway may reconnect
+                ws.session['ws'] = None
+                ws.session['expiry'] = IOLoop.current().call_later(
+                    BROKER_GATEWAY_GRACE, self.expire_gateway, ws.session
+                )
+            else:
+                # Notify clients that the nodes behind the closed gateway are out.
+                self.nodes_out(uids)
+
+    def nodes_out(self, uids):
+        """
+        Notify clients and other brokers that the given nodes are out.
+        """
+        if uids:
+            self.broadcast_gateway_out(uids)
+            if self.bus is not None:
+                self.bus.publish('leave', {'uids': list(uids)})
+
+    def add_gateway(self, ws, gateway_id=None, floor=None):
+        """
+        Register an authenticated gateway. Return the last sequence number
+        received from it when it resumes a former connection, None when it
+        has to send all its nodes.
+
+        A gateway identified by an id resumes when it reconnects before the
+        end of the grace period, and when the last sequence number received
+        is at least `floor`, the lowest one it can resume from.
+
+        Sessions are local to a broker process: a gateway reconnecting to
+        another worker or peer broker sends all its nodes again, the former
+        one being told to release them without announcing them out.
+        """
+        if not gateway_id:
+            self.gateways[ws] = set()
+            return None
+        if self.bus is not None:
+            self.bus.publish('claim', {'gateway': gateway_id})
+
+        session = self.gateway_sessions.get(gateway_id)
+        if session is not None:
+            if session['expiry'] is not None:
+                IOLoop.current().remove_timeout(session['expiry'])
+                session['expiry'] = None
+            if session['ws'] is not None:
+                # Former connection not detected as lost yet
+                logger.info("Gateway {} reconnected, closing its former link".format(gateway_id))
+                self.detach_gateway(session['ws'])
+            if session['seq'] is None or session['seq'] < (floor or 0):
+                self.gateway_sessions.pop(gateway_id)
+                self.nodes_out(session['nodes'])
+                session = None
+
+        if session is None:
+            session = {'id': gateway_id, 'seq': None, 'nodes': set(), 'expiry': None}
+            self.gateway_sessions[gateway_id] = session
+        else:
+            logger.info(
+                "Gateway {} resumes from sequence number {}".format(gateway_id, session['seq'])
+            )
+        session['ws'] = ws
+        ws.session = session
+        self.gateways[ws] = session['nodes']
+        return session['seq']
+
+    def detach_gateway(self, ws):
+        """
+        Close the former link of a gateway, frames still buffered on it are
+        ignored.
+        """
+        self.gateways.pop(ws, None)
+        ws.session = None
+        ws.close()
+
+    def release_gateway(self, gateway_id):
+        """
+        Release the session of a gateway connected to another worker or peer
+        broker.
+
+        Its nodes are not announced out right away: those still not reported
+        by another process at the end of the grace period were removed
+        meanwhile, and only those are announced out.
+        """
+        session = self.gateway_sessions.pop(gateway_id, None)
+        if session is None:
+            return
+        logger.info("Gateway {} connected elsewhere, releasing it".format(gateway_id))
+        session['released'] = True
+        if session['ws'] is not None:
+            self.detach_gateway(session['ws'])
+            session['ws'] = None
+        if session['expiry'] is None:
+            session['expiry'] = IOLoop.current().call_later(
+                BROKER_GATEWAY_GRACE, self.expire_gateway, session
+            )
+
+    def is_node_owned(self, uid):
+        """
+        Return True if a connected gateway, local or remote, has this node.
+        """
+        return (
+            any(uid in nodes for nodes in self.gateways.values()) or
+            any(uid in nodes for nodes in self.remote_nodes.values())
+        )
+
+    def expire_gateway(self, session):
+        """
+        Forget a gateway that did not reconnect in time.
+        """
+        if session.get('released'):
+            owned = {uid for uid in session['nodes'] if self.is_node_owned(uid)}
+            self.nodes_out(session['nodes'] - owned)
+            # Nodes held again by a local gateway must stay announced by
+            # this process
+            released = owned.difference(*self.gateways.values())
+            if released and self.bus is not None:
+                self.bus.publish('release', {'uids': list(released)})
+            return
+        if self.gateway_sessions.get(session['id']) is not session:
+            return
+        self.gateway_sessions.pop(session['id'])
+        logger.info("Gateway {} did not reconnect, its nodes are out".format(session['id']))
+        self.nodes_out(session['nodes'])
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Broker inter-process bus module.
+"""
+import socket
+import struct
+import logging
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+from pycots.common import codec
+
+logger = logging.getLogger("pycots.broker.bus")
+
+HEADER = struct.Struct("!I")
+MAX_EVENT_SIZE = 64 * 1024 * 1024
+
+
+def pack_event(kind, origin, message):
+    """
+    Frame an event as a length prefixed JSON document.
+    """
+    data = codec.dumps(
+        {'kind': kind, 'origin': origin, 'message': message}
+    ).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+@gen.coroutine
+def read_event(stream):
+    """
+    Read the next event from the given stream.
+    """
+    header = yield stream.read_bytes(HEADER.size)
+    length, = HEADER.unpack(header)
+    if length > MAX_EVENT_SIZE:
+        raise ValueError("Bus event too large ({} bytes)".format(length))
+    data = yield stream.read_bytes(length)
+    return codec.loads(data.decode('utf-8'))
+
+
+class BrokerBus(TCPServer):
+    """
+    Relay of broker events between the worker processes of a broker.
+
+    Worker 0 is the hub: it listens on a Unix socket and relays each event
+    received from a worker to all the other ones. Other workers connect to
+    the hub, and reconnect when it is restarted.
+
+    - `on_event(event)` is called for each event published by another
+      worker. When a worker is gone, a 'leave' event without message is
+      emitted in its name.
+    - `announce()` returns the (kind, message) events sent on each new link,
+      so that the peer learns the state of this worker.
+    - `on_disconnect()` is called when a worker loses the hub, all events
+      received from the other workers are then obsolete.
+    """
+    def __init__(self, path, worker, on_event, announce, on_disconnect):
+        super().__init__()
+        self.path = path
+        self.worker = worker
+        self.on_event = on_event
+        self.announce = announce
+        self.on_disconnect = on_disconnect
+        self.peers = {}         # stream -> origin worker, for the hub
+        self.hub = None         # stream to the hub, for other workers
+        self.closed = False
+
+    @property
+    def is_hub(self):
+        return self.worker == 0
+
+    def start_bus(self):
+        """
+        Listen as hub, or connect to it.
+        """
+        if self.is_hub:
+            self.add_socket(bind_unix_socket(self.path))
+            logger.info("Broker bus hub listening on {}".format(self.path))
+        else:
+            self.connect()
+
+    def publish(self, kind, message):
+        """
+        Send an event to all the other workers.
+        """
+        frame = pack_event(kind, self.worker, message)
+        if self.is_hub:
+            for stream in list(self.peers):
+                self._write(stream, frame)
+        elif self.hub is not None:
+            self._write(self.hub, frame)
+
+    def _write(self, stream, frame):
+        try:
+            stream.write(frame)
+        except StreamClosedError:
+            logger.debug("Broker bus link already closed")
+
+    def _announce(self, stream):
+        for kind, message in self.announce():
+            self._write(stream, pack_event(kind, self.worker, message))
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        """
+        Relay the events of a worker connected to the hub.
+        """
+        self.peers[stream] = None
+        self._announce(stream)
+        try:
+            while True:
+                event = yield read_event(stream)
+                self.peers[stream] = event['origin']
+                frame = pack_event(event['kind'], event['origin'], event['message'])
+                for peer in list(self.peers):
+                    if peer is not stream:
+                        self._write(peer, frame)
+                self._dispatch(event)
+        except (StreamClosedError, ValueError) as exc:
+            logger.debug("Broker bus link closed: {}".format(exc))
+        finally:
+            stream.close()
+            origin = self.peers.pop(stream)
+            if origin is not None and not self.closed:
+                logger.warning("Broker worker {} left the bus".format(origin))
+                self.publish_leave(origin)
+
+    def publish_leave(self, origin):
+        """
+        Notify all workers, the hub included, that a worker is gone.
+        """
+        frame = pack_event('leave', origin, None)
+        for stream in list(self.peers):
+            self._write(stream, frame)
+        self._dispatch({'kind': 'leave', 'origin': origin, 'message': None})
+
+    @gen.coroutine
+    def connect(self):
+        """
+        Connect to the hub, and reconnect until the bus is closed.
+        """
+        delay = 0.1
+        while not self.closed:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self.path)
+            except (StreamClosedError, OSError) as exc:
+                logger.debug("Cannot connect to broker bus hub: {}".format(exc))
+                stream.close()
+                yield gen.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            logger.info("Worker {} connected to broker bus".format(self.worker))
+            delay = 0.1
+            self.hub = stream
+            self._announce(stream)
+            try:
+                while True:
+                    event = yield read_event(stream)
+                    self._dispatch(event)
+            except (StreamClosedError, ValueError) as exc:
+                logger.warning("Broker bus hub lost: {}".format(exc))
+            finally:
+                stream.close()
+                self.hub = None
+            if not self.closed:
+                self.on_disconnect()
+
+    def _dispatch(self, event):
+        try:
+            self.on_event(event)
+        except Exception:
+            logger.exception("Error while handling broker bus event")
+
+    def close(self):
+        """
+        Close all bus links.
+        """
+        self.closed = True
+        self.stop()
+        for stream in list(self.peers):
+            stream.close()
+        if self.hub is not None:
+            self.hub.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Broker node state cache module.
+"""
+import logging
+
+logger = logging.getLogger("pycots.broker.cache")
+
+
+class NodeStateCache():
+    """
+    Latest known resources of each node, built from the messages of
+    gateways: {uid: {endpoint: data}}.
+
+    New clients get their initial state from this cache instead of
+    asking every gateway to replay its own.
+    """
+    def __init__(self):
+        self.nodes = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, uid):
+        return uid in self.nodes
+
+    def add(self, uid):
+        """
+        Register a node, its resources being filled by updates.
+        """
+        self.nodes.setdefault(uid, {})
+
+    def update(self, uid, endpoint, data):
+        """
+        Store the latest value of a node resource.
+        """
+        self.nodes.setdefault(uid, {})[endpoint] = data
+
+    def set(self, uid, resources):
+        """
+        Replace all the resources of a node.
+        """
+        self.nodes[uid] = dict(resources)
+
+    def reset(self, uid):
+        """
+        Forget the resources of a reset node.
+        """
+        if uid in self.nodes:
+            self.nodes[uid] = {}
+
+    def remove(self, uid):
+        """
+        Forget a node gone.
+        """
+        self.nodes.pop(uid, None)
+
+    def snapshot(self, wants=None):
+        """
+        Return the state of the nodes, only the resources for which
+        `wants(uid, endpoint)` is true when given.
+
+        Without filter, the cache itself is returned: it must be serialized
+        right away.
+        """
+        if wants is None:
+            return self.nodes
+        snapshot = {}
+        for uid, resources in self.nodes.items():
+            if not wants(uid, None):
+                continue
+            snapshot[uid] = {
+                endpoint: data for endpoint, data in resources.items()
+                if wants(uid, endpoint)
+            }
+        return snapshot
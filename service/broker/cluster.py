@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Broker cluster module.
+"""
+import logging
+from functools import partial
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+from pycots.common import codec
+from pycots.common.auth import auth_token, peer_proof, verify_peer_proof
+from pycots.common.connection import ConnectionManager, CONNECTED
+
+logger = logging.getLogger("pycots.broker.cluster")
+
+
+class BrokerCluster():
+    """
+    Links between the brokers of a cluster.
+
+    Each broker dials the '/peer' endpoint of the brokers given in `peers`
+    and authenticates with the shared keys. The dialed broker answers with
+    a proof of the keys bound to the token received, so that both sides are
+    authenticated. Both sides then exchange a 'hello' event with their
+    broker id. Events have the same form as on the broker
+    bus, {'kind', 'origin', 'message'}, and are delivered by the receiving
+    broker to its own clients and gateways only: the cluster is a full mesh,
+    every pair of brokers being linked in at least one direction.
+
+    When two brokers are linked in both directions, events are sent on one
+    link only. When the last link to a peer is lost, a 'leave' event without
+    message is emitted in its name.
+    """
+    def __init__(self, broker_id, keys, peers, on_event, announce):
+        self.broker_id = broker_id
+        self.keys = keys
+        self.urls = peers
+        self.on_event = on_event
+        self.announce = announce
+        self.links = {}         # link -> peer broker id, None before hello
+        self.peers = {}         # peer broker id -> list of links
+        self.dialers = []
+        self.pending = {}       # dialed link -> token, until the peer proof
+
+    def start_bus(self):
+        """
+        Dial the configured peers, and keep dialing them.
+        """
+        for url in self.urls:
+            link = ConnectionManager(url, None)
+            link.on_message = partial(self.on_link_message, link)
+            link.add_state_callback(partial(self.on_dialer_state, link))
+            self.dialers.append(link)
+            IOLoop.current().add_callback(link.run)
+
+    def on_dialer_state(self, link, state):
+        if state == CONNECTED:
+            logger.info("Connected to peer broker {}".format(link.url))
+            token = auth_token(self.keys)
+            self.pending[link] = token
+            self._write(link, token)
+        else:
+            self.pending.pop(link, None)
+            self.remove_link(link)
+
+    def on_peer_proof(self, link, raw):
+        """
+        Check the answer of a dialed broker to the auth token sent.
+        """
+        token = self.pending.pop(link)
+        if not verify_peer_proof(raw, token, self.keys):
+            logger.warning("Peer broker {} failed to authenticate, closing".format(link.url))
+            # Dialed again after a backoff
+            link.connection.close()
+            return
+        link.reset_backoff()
+        self.add_link(link)
+
+    def _write(self, link, message):
+        try:
+            link.write_message(message)
+        except (WebSocketClosedError, StreamClosedError, AttributeError):
+            logger.debug("Peer broker link already closed")
+
+    def _event(self, kind, message):
+        return codec.dumps(
+            {'kind': kind, 'origin': self.broker_id, 'message': message}
+        )
+
+    def add_link(self, link):
+        """
+        Register an authenticated link and introduce this broker.
+        """
+        self.links[link] = None
+        self._write(link, self._event('hello', None))
+
+    def remove_link(self, link):
+        """
+        Forget a closed link.
+        """
+        origin = self.links.pop(link, None)
+        if origin is None:
+            return
+        links = self.peers[origin]
+        links.remove(link)
+        if not links:
+            logger.warning("Peer broker {} left the cluster".format(origin))
+            del self.peers[origin]
+            self._dispatch({'kind': 'leave', 'origin': origin, 'message': None})
+
+    def accept_link(self, link, token):
+        """
+        Register a link authenticated by the given token, proving the keys
+        in return.
+        """
+        self._write(link, peer_proof(token, self.keys))
+        self.add_link(link)
+
+    def on_link_message(self, link, raw):
+        """
+        Handle an event received from a peer broker.
+        """
+        if link in self.pending:
+            self.on_peer_proof(link, raw)
+            return
+        try:
+            event = codec.loads(raw)
+            kind, origin = event['kind'], event['origin']
+        except (codec.DecodeError, KeyError, TypeError) as exc:
+            logger.debug("Invalid peer broker event: {}".format(exc))
+            return
+
+        if kind == "hello":
+            if link not in self.links or self.links[link] is not None:
+                return
+            if origin == self.broker_id:
+                logger.warning("Broker linked to itself, closing")
+                link.close()
+                return
+            self.links[link] = origin
+            links = self.peers.setdefault(origin, [])
+            links.append(link)
+            if len(links) == 1:
+                logger.info("Peer broker {} joined the cluster".format(origin))
+                for kind, message in self.announce():
+                    self._write(link, self._event(kind, message))
+        elif self.links.get(link) == origin:
+            self._dispatch(event)
+
+    def publish(self, kind, message):
+        """
+        Send an event to all peer brokers.
+        """
+        frame = self._event(kind, message)
+        for links in self.peers.values():
+            self._write(links[0], frame)
+
+    def _dispatch(self, event):
+        try:
+            self.on_event(event)
+        except Exception:
+            logger.exception("Error while handling peer broker event")
+
+    def close(self):
+        """
+        Close all peer links.
+        """
+        for link in self.dialers:
+            link.close()
+        for link in list(self.links):
+            link.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Broker message fan-out module.
+"""
+import struct
+import logging
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+logger = logging.getLogger("pycots.broker.fanout")
+
+FIN = 0x80
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+
+
+def _frame(opcode, data):
+    """
+    Build an unmasked and uncompressed websocket frame.
+    """
+    length = len(data)
+    if length < 126:
+        header = struct.pack("BB", FIN | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", FIN | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", FIN | opcode, 127, length)
+    return header + data
+
+
+def _frame_stream(connection):
+    """
+    Return the stream of a websocket connection accepting prepared frames,
+    None if the connection masks or compresses its frames.
+
+    This relies on tornado private attributes: if they are missing, the
+    connection is not written to directly.
+    """
+    try:
+        if connection._compressor is not None or connection.mask_outgoing:
+            return None
+        return connection.stream
+    except AttributeError:
+        return None
+
+
+class PreparedMessage():
+    """
+    Websocket message encoded and framed once, then written as is to every
+    recipient.
+
+    Server side frames are not masked, so the same frame bytes are valid for
+    all connections that didn't negotiate compression. Other connections
+    fall back to the regular `write_message`.
+    """
+    __slots__ = ('data', 'binary', '_frame')
+
+    def __init__(self, message, binary=False):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self.data = message
+        self.binary = binary
+        self._frame = None
+
+    def __str__(self):
+        if self.binary:
+            return repr(self.data)
+        return self.data.decode('utf-8')
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = _frame(
+                OPCODE_BINARY if self.binary else OPCODE_TEXT, self.data
+            )
+        return self._frame
+
+    def write_to(self, handler):
+        """
+        Write the message to the given websocket handler, return a Future.
+        """
+        connection = handler.ws_connection
+        if connection is None or connection.is_closing():
+            raise WebSocketClosedError()
+        stream = _frame_stream(connection)
+        if stream is None:
+            return handler.write_message(self.data, binary=self.binary)
+        try:
+            return stream.write(self.frame)
+        except StreamClosedError:
+            raise WebSocketClosedError()
@@ -4,11 +4,52 @@
 Broker application module.
 """
 import sys
-from tornado.options import options
+from tornado.options import define, options
+from tornado.process import fork_processes
 
 from pycots.common.auth import check_key_file
 from pycots.common.helpers import start_application, parse_command_line
 from pycots.service.broker.broker import Broker, logger
+from pycots.service.settings import (
+    BROKER_CLIENT_QUEUE_SIZE, BROKER_CLIENT_OVERFLOW, BROKER_WORKERS,
+    BROKER_BUS_PATH, BROKER_PEERS, BROKER_ID
+)
+
+
+def extra_args():
+    """
+    Parse command line arguments for the broker application.
+    """
+    if not hasattr(options, "client_queue_size"):
+        define(
+            "client_queue_size", default=BROKER_CLIENT_QUEUE_SIZE,
+            help="Maximum number of messages queued for a web client"
+        )
+    if not hasattr(options, "client_overflow"):
+        define(
+            "client_overflow", default=BROKER_CLIENT_OVERFLOW,
+            help="What to do with clients having a full queue: 'coalesce' or 'disconnect'"
+        )
+    if not hasattr(options, "workers"):
+        define(
+            "workers", default=BROKER_WORKERS,
+            help="Number of broker processes, 0 for one per CPU"
+        )
+    if not hasattr(options, "bus_path"):
+        define(
+            "bus_path", default=BROKER_BUS_PATH,
+            help="Unix socket relaying events between broker processes"
+        )
+    if not hasattr(options, "peers"):
+        define(
+            "peers", default=BROKER_PEERS,
+            help="Comma separated URLs of the peer brokers of a cluster, e.g. 'ws://host:8002/peer'"
+        )
+    if not hasattr(options, "broker_id"):
+        define(
+            "broker_id", default=BROKER_ID,
+            help="Unique id of this broker in a cluster, random when empty"
+        )
 
 
 def run(arguments=[]):
@@ -19,7 +60,7 @@ def run(arguments=[]):
         sys.argv[1:] = arguments
 
     try:
-        parse_command_line()
+        parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
         logger.error("Invalid config file: {}".format(exc))
         return
@@ -33,8 +74,23 @@ def run(arguments=[]):
         logger.error(exc)
         return
 
+    if (options.peers or options.broker_id) and options.workers != 1:
+        logger.error("A clustered broker cannot run several workers")
+        return
+
+    if options.workers == 1:
+        start_application(
+            Broker(keys, options=options), port=options.broker_port
+        )
+        return
+
+    # Each worker listens on the broker port, connections are spread by
+    # the kernel and routing is shared through the broker bus.
+    worker = fork_processes(options.workers)
+    logger.info("Broker worker {} started".format(worker))
     start_application(
-        Broker(keys, options=options), port=options.broker_port
+        Broker(keys, options=options, worker=worker),
+        port=options.broker_port, reuse_port=True
     )
 
 if __name__ == '__main__':
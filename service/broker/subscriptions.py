@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Broker client subscriptions module.
+"""
+import logging
+
+logger = logging.getLogger("pycots.broker.subscriptions")
+
+WILDCARD = '*'
+
+
+class SubscriptionIndex():
+    """
+    Inverted index from (node uid, endpoint) to the subscribed clients.
+
+    Either the uid or the endpoint of a subscription can be the '*' wildcard.
+    Clients that never subscribed receive everything.
+    """
+    def __init__(self):
+        self.unfiltered = set()
+        self._index = {}        # (uid, endpoint) -> set of client uids
+        self._nodes = {}        # uid -> {client uid: subscription count}
+        self._clients = {}      # client uid -> set of (uid, endpoint)
+
+    def add_client(self, client):
+        """
+        Register a connected client, it receives everything until it
+        subscribes to something.
+        """
+        if client not in self._clients:
+            self.unfiltered.add(client)
+
+    def remove_client(self, client):
+        """
+        Forget a client and all its subscriptions.
+        """
+        self.unfiltered.discard(client)
+        for uid, endpoint in self._clients.pop(client, ()):
+            self._discard(client, uid, endpoint)
+
+    def subscribe(self, client, uid=WILDCARD, endpoint=WILDCARD):
+        """
+        Subscribe a client to the given node uid and endpoint.
+        """
+        self.unfiltered.discard(client)
+        keys = self._clients.setdefault(client, set())
+        if (uid, endpoint) in keys:
+            return
+        keys.add((uid, endpoint))
+        self._index.setdefault((uid, endpoint), set()).add(client)
+        counts = self._nodes.setdefault(uid, {})
+        counts[client] = counts.get(client, 0) + 1
+
+    def unsubscribe(self, client, uid=WILDCARD, endpoint=WILDCARD):
+        """
+        Remove a subscription of a client.
+        """
+        keys = self._clients.get(client)
+        if keys is None or (uid, endpoint) not in keys:
+            return
+        keys.remove((uid, endpoint))
+        self._discard(client, uid, endpoint)
+
+    def _discard(self, client, uid, endpoint):
+        subscribers = self._index[(uid, endpoint)]
+        subscribers.discard(client)
+        if not subscribers:
+            self._index.pop((uid, endpoint))
+        counts = self._nodes[uid]
+        counts[client] -= 1
+        if not counts[client]:
+            counts.pop(client)
+            if not counts:
+                self._nodes.pop(uid)
+
+    def subscribers(self, uid, endpoint=None):
+        """
+        Return the set of clients subscribed to an event on the given node.
+
+        Without endpoint, the event concerns the node itself (new, out,
+        reset) and all clients subscribed to any of its endpoints match.
+        """
+        result = set()
+        if endpoint is None:
+            for key in (uid, WILDCARD):
+                result.update(self._nodes.get(key, ()))
+        else:
+            for key in ((uid, endpoint), (uid, WILDCARD),
+                        (WILDCARD, endpoint), (WILDCARD, WILDCARD)):
+                result.update(self._index.get(key, ()))
+        return result
+
+    def recipients(self, uid, endpoint=None):
+        """
+        Return the set of clients interested by an event on the given node.
+        """
+        return self.unfiltered.union(self.subscribers(uid, endpoint))
+
+    def wants(self, client, uid, endpoint=None):
+        """
+        Return True if the client is interested by an event on the given node.
+        """
+        if client in self.unfiltered:
+            return True
+        keys = self._clients.get(client)
+        if not keys:
+            return False
+        if endpoint is None:
+            return (client in self._nodes.get(uid, ()) or
+                    client in self._nodes.get(WILDCARD, ()))
+        return bool(keys.intersection((
+            (uid, endpoint), (uid, WILDCARD),
+            (WILDCARD, endpoint), (WILDCARD, WILDCARD)
+        )))
@@ -1,3 +1,13 @@
+#Broker
+BROKER_AUTH_TIMEOUT = 5  # seconds, for gateways to authenticate
+BROKER_GATEWAY_GRACE = 30  # seconds the nodes of a lost gateway are kept
+BROKER_CLIENT_QUEUE_SIZE = 1000  # messages queued per client
+BROKER_CLIENT_OVERFLOW = 'coalesce'  # 'coalesce' or 'disconnect'
+BROKER_WORKERS = 1  # processes sharing the broker port
+BROKER_BUS_PATH = '/tmp/pycots-broker-{}.sock'  # formatted with the broker port
+BROKER_PEERS = ''  # comma separated peer URLs, e.g. 'ws://host:8002/peer'
+BROKER_ID = ''  # unique id in the cluster, random when empty
+
 # COAP_SERVER_IP = 'localhost'
 # COAP_SERVER_PORT = 5689
 # COAP_MAX_RETENTION_TIME = 120
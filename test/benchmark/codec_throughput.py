@@ -0,0 +1,51 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Encode/decode throughput of the available JSON backends.
+
+Usage: python -m pycots.test.benchmark.codec_throughput [ITERATIONS]
+"""
+# -*- coding: utf-8 -*-
+import sys
+import timeit
+from pycots.common import codec
+
+UID = '8b1a8e34-5b8c-4bd6-9d0e-7b8e5a2c6f31'
+
+MESSAGES = {
+    'new': {'type': 'new', 'uid': UID, 'dst': 'all'},
+    'out': {'type': 'out', 'uid': UID},
+    'reset': {'type': 'reset', 'uid': UID},
+    'update': {
+        'type': 'update', 'uid': UID, 'endpoint': 'temperature',
+        'data': '23°C', 'dst': 'all'
+    },
+    'batch': {
+        'type': 'batch', 'dst': 'all',
+        'updates': [
+            {'uid': UID, 'endpoint': 'imu', 'data': '{}'.format(index)}
+            for index in range(100)
+        ]
+    },
+    'gateway_out': {'type': 'gateway_out', 'uids': [UID] * 1000},
+}
+
+
+def main(iterations):
+    print("{:>12} {:>8} {:>14} {:>14}".format(
+        'message', 'backend', 'encode (msg/s)', 'decode (msg/s)'
+    ))
+    for name, message in MESSAGES.items():
+        for backend, (dumps, loads) in codec.BACKENDS.items():
+            raw = dumps(message)
+            encode = timeit.timeit(lambda: dumps(message), number=iterations)
+            decode = timeit.timeit(lambda: loads(raw), number=iterations)
+            print("{:>12} {:>8} {:>14.0f} {:>14.0f}".format(
+                name, backend, iterations / encode, iterations / decode
+            ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,135 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Dispatch throughput of the MQTT gateway messages.
+
+Usage: python -m pycots.test.benchmark.mqtt_dispatch [MESSAGES] [NODES]
+"""
+# -*- coding: utf-8 -*-
+import sys
+import time
+import random
+from pycots.common import codec
+from pycots.gateway.base.node import Node
+from pycots.gateway.mqtt.router import TopicRouter
+
+RESOURCES = ['led', 'temperature', 'pressure', 'imu']
+
+
+class Handlers():
+    """
+    MQTT gateway handlers, without the network side.
+    """
+    def __init__(self, count):
+        self.nodes = {}
+        self.node_mapping = {}
+        for index in range(count):
+            node = Node('uid-{}'.format(index), id='node-{}'.format(index))
+            self.nodes[node.uid] = node
+            self.node_mapping[node.resources['id']] = node.uid
+        self.forwarded = 0
+
+    def handle_node_check(self, data):
+        pass
+
+    def handle_node_resources(self, node_id, data):
+        pass
+
+    def forward_data_from_node(self, node, resource, value):
+        self.forwarded += 1
+
+    def former_node_update(self, topic_name, data):
+        _, node_id, resource = topic_name.split("/")
+        value = data['value']
+        if self.node_mapping[node_id] not in self.nodes:
+            return
+        node = self.nodes[self.node_mapping[node_id]]
+        self.forward_data_from_node(node, resource, value)
+
+    def handle_node_update(self, node_id, resource, data):
+        node = self.nodes.get(self.node_mapping.get(node_id))
+        if node is None:
+            return
+        self.forward_data_from_node(node, resource, data['value'])
+
+
+def former_dispatch(handlers, topic_name, data):
+    """
+    Former dispatch of the MQTT gateway, by topic suffix.
+    """
+    if topic_name.endswith("/check"):
+        handlers.handle_node_check(data)
+    elif topic_name.endswith("/resources"):
+        handlers.handle_node_resources(topic_name.split("/")[1], data)
+    else:
+        handlers.former_node_update(topic_name, data)
+
+
+def router_dispatch(router):
+    def dispatch(handlers, topic_name, data):
+        route = router.route(topic_name)
+        if route is not None:
+            handler, params = route
+            handler(*params, data)
+    return dispatch
+
+
+def messages(count, nodes):
+    """
+    Build `count` (topic, payload) messages: mostly updates, some checks
+    and resources.
+    """
+    generator = random.Random(0)
+    result = []
+    for index in range(count):
+        node_id = 'node-{}'.format(generator.randrange(nodes))
+        draw = generator.random()
+        if draw < 0.01:
+            result.append(('node/check', '{{"id": "{}"}}'.format(node_id)))
+        elif draw < 0.02:
+            result.append(('node/{}/resources'.format(node_id), '["led"]'))
+        else:
+            resource = generator.choice(RESOURCES)
+            result.append((
+                'node/{}/{}'.format(node_id, resource),
+                '{{"value": "{}"}}'.format(index)
+            ))
+    return result
+
+
+def measure(dispatch, handlers, stream, decode=True):
+    """
+    Return the messages per second going through `dispatch`, payloads
+    decoded or not.
+    """
+    if not decode:
+        stream = [(topic_name, codec.loads(payload)) for topic_name, payload in stream]
+    start = time.perf_counter()
+    for topic_name, payload in stream:
+        dispatch(handlers, topic_name, codec.loads(payload) if decode else payload)
+    return len(stream) / (time.perf_counter() - start)
+
+
+def main(count, nodes):
+    handlers = Handlers(nodes)
+    router = TopicRouter()
+    router.add('node/check', handlers.handle_node_check)
+    router.add('node/+/resources', handlers.handle_node_resources)
+    router.add('node/+/+', handlers.handle_node_update)
+    stream = messages(count, nodes)
+
+    print("{:>10} {:>14} {:>18}".format('dispatch', 'msg/s', 'msg/s (decoded)'))
+    for name, dispatch in (('suffix', former_dispatch), ('router', router_dispatch(router))):
+        print("{:>10} {:>14.0f} {:>18.0f}".format(
+            name, measure(dispatch, handlers, stream, decode=False),
+            measure(dispatch, handlers, stream, decode=True)
+        ))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    )
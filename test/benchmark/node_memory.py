@@ -0,0 +1,63 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Memory benchmark of the gateway node layout.
+
+Usage: python -m pycots.test.benchmark.node_memory [NODES]
+"""
+# -*- coding: utf-8 -*-
+import sys
+import time
+import tracemalloc
+from pycots.gateway.base.node import Node
+
+RESOURCES = ['protocol', 'name', 'os', 'board', 'led', 'temperature', 'pressure', 'imu']
+
+
+class DictNode():
+    """
+    Former node layout: per-instance __dict__, resource names not interned.
+    """
+    def __init__(self, uid, **default_resources):
+        self.uid = uid
+        self.last_seen = time.time()
+        self.resources = default_resources
+
+    def set_resource_value(self, resource, value):
+        if resource not in self.resources:
+            self.resources.update({resource: value})
+        else:
+            self.resources[resource] = value
+
+
+def measure(node_class, count):
+    """
+    Return the memory, in bytes, used by `count` nodes of `node_class`.
+    """
+    tracemalloc.start()
+    nodes = {}
+    for index in range(count):
+        uid = 'node-{:08d}'.format(index)
+        node = node_class(uid, ip='fd00::{:x}'.format(index))
+        for resource in RESOURCES:
+            # Resource names are parsed from the network, build a new string
+            topic = 'node/{}/{}'.format(index, resource)
+            node.set_resource_value(topic.split('/')[2], '0')
+        nodes[uid] = node
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main(count):
+    for node_class in (DictNode, Node):
+        size = measure(node_class, count)
+        print("{:>10}: {:8.1f} MiB for {} nodes ({:.0f} B/node)".format(
+            node_class.__name__, size / 2 ** 20, count, size / count
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
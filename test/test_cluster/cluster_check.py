@@ -0,0 +1,181 @@
+"""
+COT Service
+
+Author: Tony Chi
+Updated at: 2018-06
+Content : Check of a cluster of brokers running on localhost.
+
+Brokers are started in this process, each one dialing all the others. A
+gateway attached to the first broker and clients attached to the others
+check that node events go through the cluster both ways, that brokers
+without the keys are not linked, and that a lost broker is detected.
+
+Usage: python -m pycots.test.test_cluster.cluster_check [BROKERS] [BASE_PORT]
+"""
+# -*- coding: utf-8 -*-
+import sys
+import json
+import types
+import logging
+from tornado import gen, web, websocket
+from tornado.ioloop import IOLoop
+from pycots.common import auth, codec
+from pycots.service.broker.broker import Broker
+
+PEER_URL = 'ws://localhost:{}/peer'
+
+
+def broker_options(port, peers, broker_id):
+    return types.SimpleNamespace(
+        debug=False, broker_port=port, client_queue_size=1000,
+        client_overflow='coalesce', bus_path='', broker_id=broker_id,
+        peers=','.join(PEER_URL.format(peer) for peer in peers)
+    )
+
+
+class RogueHandler(websocket.WebSocketHandler):
+    """
+    Peer endpoint of a broker without the keys: the auth token received is
+    sent back as proof, followed by a hello.
+    """
+    def on_message(self, raw):
+        self.write_message(raw)
+        self.write_message(codec.dumps(
+            {'kind': 'hello', 'origin': 'rogue', 'message': None}
+        ))
+
+
+class Endpoint():
+    """
+    Websocket connection keeping the messages received.
+    """
+    def __init__(self):
+        self.received = []
+        self.connection = None
+
+    @gen.coroutine
+    def connect(self, url):
+        self.connection = yield websocket.websocket_connect(
+            url, on_message_callback=self.on_message
+        )
+
+    def on_message(self, message):
+        if message is not None:
+            self.received.append(json.loads(message))
+
+    def write(self, message):
+        self.connection.write_message(json.dumps(message))
+
+    def types(self):
+        return [message['type'] for message in self.received]
+
+
+@gen.coroutine
+def wait_until(predicate, timeout=10):
+    deadline = IOLoop.current().time() + timeout
+    while not predicate():
+        if IOLoop.current().time() > deadline:
+            return False
+        yield gen.sleep(0.05)
+    return True
+
+
+@gen.coroutine
+def run_checks(count, base_port):
+    keys = auth.Keys(private=auth.generate_private_key(), secret=auth.generate_secret_key())
+    other_keys = auth.Keys(private=auth.generate_private_key(), secret=auth.generate_secret_key())
+    ports = [base_port + index for index in range(count)]
+    rogue_port, intruder_port = base_port + count, base_port + count + 1
+    results = []
+
+    def check(name, passed):
+        results.append(passed)
+        print("{:<56} {}".format(name, "ok" if passed else "FAILED"))
+
+    brokers, servers = [], []
+    for port in ports:
+        peers = [peer for peer in ports if peer != port]
+        if port == ports[0]:
+            peers.append(rogue_port)
+        broker = Broker(keys, broker_options(port, peers, 'broker-{}'.format(port)))
+        servers.append(broker.listen(port))
+        brokers.append(broker)
+    web.Application([(r"/peer", RogueHandler)]).listen(rogue_port)
+    intruder = Broker(other_keys, broker_options(intruder_port, ports[:1], 'intruder'))
+    intruder.listen(intruder_port)
+
+    expected = sorted('broker-{}'.format(port) for port in ports)
+    linked = yield wait_until(lambda: all(
+        broker.metrics()['peers'] == sorted(set(expected) - {broker.bus.broker_id})
+        for broker in brokers
+    ))
+    check("{} brokers linked in a full mesh".format(count), linked)
+    check("brokers without the keys not linked", (
+        'rogue' not in brokers[0].metrics()['peers'] and
+        'intruder' not in brokers[0].metrics()['peers'] and
+        not intruder.metrics()['peers']
+    ))
+
+    # Gateway attached to the first broker
+    gateway = Endpoint()
+    yield gateway.connect('ws://localhost:{}/gw'.format(ports[0]))
+    gateway.connection.write_message(auth.auth_token(keys))
+    yield wait_until(lambda: gateway.received)
+    gateway.write({'type': 'new', 'uid': 'n1', 'dst': 'all'})
+    gateway.write({'type': 'update', 'uid': 'n1', 'endpoint': 'led', 'data': '0', 'dst': 'all'})
+
+    clients = []
+    for port in ports[1:]:
+        client = Endpoint()
+        yield client.connect('ws://localhost:{}/ws'.format(port))
+        clients.append(client)
+    yield wait_until(lambda: all(
+        broker.states.nodes.get('n1') == {'led': '0'} for broker in brokers
+    ))
+    for client in clients:
+        client.write({'type': 'new', 'snapshot': True})
+    snapshots = yield wait_until(lambda: all(
+        client.received and
+        client.received[0].get('nodes', {}).get('n1') == {'led': '0'}
+        for client in clients
+    ))
+    check("node state served by every broker", snapshots)
+
+    clients[-1].write({
+        'type': 'update', 'data': {'uid': 'n1', 'endpoint': 'led', 'payload': '1'}
+    })
+    forwarded = yield wait_until(lambda: any(
+        message['type'] == 'update' for message in gateway.received
+    ))
+    check("client update forwarded to the gateway", forwarded)
+
+    gateway.write({'type': 'update', 'uid': 'n1', 'endpoint': 'led', 'data': '1', 'dst': 'all'})
+    updated = yield wait_until(lambda: all(
+        client.received[-1].get('data') == '1' for client in clients
+    ))
+    check("gateway update received by every client", updated)
+
+    # Loss of the broker holding the gateway
+    servers[0].stop()
+    brokers[0].bus.close()
+    out = yield wait_until(lambda: all(
+        'gateway_out' in client.types() for client in clients
+    ))
+    check("nodes out when their broker leaves the cluster", out)
+
+    return all(results)
+
+
+def main(count, base_port):
+    logging.basicConfig(level=logging.ERROR)
+    passed = IOLoop.current().run_sync(
+        lambda: run_checks(count, base_port), timeout=60
+    )
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 3,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8200
+    )